@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Measures how fast events are ingested on the server side, from
+``SentryClient.process`` through ``GroupedMessage.objects.from_kwargs``,
+using the test settings and an in-memory SQLite database.
+
+Usage::
+
+    python runbenchmarks.py [--events=1000] [--output=results.json] [scenario ...]
+"""
+import datetime
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+# Configures the same settings as the test suite
+from runtests import settings
+
+from django.core.management.color import no_style
+from django.db import connection, models, reset_queries
+from django.utils import simplejson
+
+from sentry import conf
+
+def create_stand_ins():
+    """
+    Defines a model for each one the models of Sentry refer to (such as
+    ``main.Project``) which isn't installed, so the test database can be
+    created. Their tables are created by ``create_stand_in_tables``.
+    """
+    from sentry import models as sentry_models
+
+    stand_ins = []
+    for model in models.get_models(sentry_models):
+        for field in model._meta.fields:
+            if field.rel and isinstance(field.rel.to, basestring):
+                app_label, name = field.rel.to.split('.')
+                stand_ins.append(type(name, (models.Model,), {
+                    '__module__': __name__,
+                    'name': models.CharField(max_length=200),
+                    'Meta': type('Meta', (), {'app_label': app_label}),
+                }))
+    return stand_ins
+
+def create_stand_in_tables(stand_ins):
+    cursor = connection.cursor()
+    for model in stand_ins:
+        for sql in connection.creation.sql_create_model(model, no_style())[0]:
+            cursor.execute(sql)
+
+def create_project():
+    from sentry.models import GroupedMessage
+
+    model = GroupedMessage._meta.get_field('project').rel.to
+    return model.objects.create(name='Benchmark')
+
+def new_groups(client, i, extra):
+    client.process(message='New group %d' % (i,), **extra)
+
+def repeat_groups(client, i, extra):
+    client.process(message='Repeated group %d' % (i % 10,), **extra)
+
+def large_data(client, i, extra):
+    data = dict(('key_%d' % n, 'x' * 1024) for n in xrange(0, 200))
+    client.process(message='Large data', data=data, **extra)
+
+def deep_traceback(client, i, extra):
+    def recurse(depth, values):
+        if not depth:
+            raise ValueError('Deep traceback')
+        return recurse(depth - 1, values[:])
+    try:
+        recurse(100, range(0, 10))
+    except ValueError:
+        client.create_from_exception(**extra)
+
+# (name, function, number of groups created by ``n`` events)
+SCENARIOS = (
+    ('new_groups', new_groups, lambda n: n),
+    ('repeat_groups', repeat_groups, lambda n: min(n, 10)),
+    ('large_data', large_data, lambda n: 1),
+    ('deep_traceback', deep_traceback, lambda n: 1),
+)
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def run_scenario(func, num_events, num_groups, extra):
+    from sentry.caches import clear_caches
+    from sentry.client.base import SentryClient
+    from sentry.models import GroupedMessage, Message
+
+    Message.objects.all().delete()
+    GroupedMessage.objects.all().delete()
+    clear_caches()
+
+    client = SentryClient()
+    timings = []
+    num_queries = 0
+    for i in xrange(0, num_events):
+        reset_queries()
+        start = time.time()
+        func(client, i, extra)
+        timings.append(time.time() - start)
+        num_queries += len(connection.queries)
+
+    # Ingestion logs its errors instead of raising them
+    stored = Message.objects.count()
+    if stored != num_events:
+        raise RuntimeError('%d of %d events were stored, see the errors logged above'
+                           % (stored, num_events))
+    stored = GroupedMessage.objects.count()
+    if stored != num_groups:
+        raise RuntimeError('%d groups were stored instead of %d' % (stored, num_groups))
+
+    total = sum(timings)
+    return {
+        'events': num_events,
+        'total_seconds': total,
+        'events_per_second': total and num_events / total or 0,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'queries_per_event': float(num_queries) / num_events,
+    }
+
+def runbenchmarks(*args):
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--events', dest='events', type='int', default=1000,
+                      help='Number of events to ingest per scenario')
+    parser.add_option('--output', dest='output', default=None,
+                      help='Write the results as JSON to this file')
+    options, scenarios = parser.parse_args(list(args))
+
+    available = dict((s[0], s[1:]) for s in SCENARIOS)
+    for name in scenarios:
+        if name not in available:
+            parser.error('Unknown scenario: %s (choose from %s)' % (name, ', '.join(available)))
+    if not scenarios:
+        scenarios = [s[0] for s in SCENARIOS]
+
+    if 'south' in settings.INSTALLED_APPS:
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+
+    # Every event must be stored for the numbers to mean anything
+    conf.THRASHING_LIMIT = 0
+    conf.AGGREGATE_INTERVAL = 0
+    conf.SAMPLE_THRESHOLD = 0
+    conf.SAMPLE_THRESHOLDS = {}
+    conf.KEEP_LAST_MESSAGES = 0
+    conf.EXCEPTION_POOL_SIZE = 0
+    conf.REMOTE_URL = None
+
+    stand_ins = create_stand_ins()
+    old_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0)
+    # Required for connection.queries to be recorded
+    settings.DEBUG = True
+
+    results = {}
+    try:
+        create_stand_in_tables(stand_ins)
+        extra = {'project': create_project()}
+
+        for name in scenarios:
+            func, num_groups = available[name]
+            results[name] = run_scenario(func, options.events, num_groups(options.events), extra)
+            print '%(name)-16s %(events_per_second)10.1f events/sec  p50 %(p50_ms)7.2fms  '\
+                  'p99 %(p99_ms)7.2fms  %(queries_per_event)5.1f queries/event' % dict(results[name], name=name)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if options.output:
+        fp = open(options.output, 'w')
+        try:
+            simplejson.dump({
+                'date': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'database': connection.settings_dict['ENGINE'],
+                'results': results,
+            }, fp, indent=2)
+        finally:
+            fp.close()
+
+if __name__ == '__main__':
+    runbenchmarks(*sys.argv[1:])
@@ -0,0 +1,213 @@
+"""
+Write-behind buffering of ``GroupedMessage`` counters.
+
+When ``SENTRY_BUFFER`` is enabled, ``times_seen`` increments and the most
+recent ``last_seen`` are collected per group instead of being written for
+every event, and a background thread writes them out with a single
+``UPDATE`` per group every ``SENTRY_BUFFER_INTERVAL`` seconds.
+"""
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import models
+
+from sentry import conf
+
+logger = logging.getLogger('sentry.errors')
+
+class BaseBuffer(object):
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = conf.BUFFER_INTERVAL
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def incr(self, group_id, count=1, last_seen=None):
+        """
+        Records ``count`` new occurrences of the given group.
+        """
+        self._incr(group_id, count, last_seen or datetime.datetime.now())
+        self._ensure_thread()
+
+    def get_pending(self, group_id):
+        """
+        Returns a ``(count, last_seen)`` tuple of the changes which have not
+        yet been written for the given group.
+        """
+        raise NotImplementedError
+
+    def apply(self, groups):
+        """
+        Merges pending changes into a list of ``GroupedMessage`` instances so
+        that they reflect (approximately) live counts.
+        """
+        groups = list(groups)
+        for group in groups:
+            count, last_seen = self.get_pending(group.pk)
+            if count:
+                group.times_seen += count
+            if last_seen and last_seen > group.last_seen:
+                group.last_seen = last_seen
+        return groups
+
+    def flush(self):
+        """
+        Writes all pending changes to the database.
+        """
+        from sentry.models import GroupedMessage
+
+        for group_id, (count, last_seen) in self._pop_pending():
+            if not count:
+                continue
+            try:
+                GroupedMessage.objects.filter(pk=group_id).update(
+                    times_seen=models.F('times_seen') + count,
+                    status=0,
+                    last_seen=last_seen,
+                )
+            except Exception, exc:
+                logger.exception(u'Unable to flush buffered counters: %s' % (exc,))
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.isAlive():
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def _incr(self, group_id, count, last_seen):
+        raise NotImplementedError
+
+    def _pop_pending(self):
+        raise NotImplementedError
+
+class MemoryBuffer(BaseBuffer):
+    """
+    Keeps pending changes in process memory.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MemoryBuffer, self).__init__(*args, **kwargs)
+        self._pending = {}
+
+    def get_pending(self, group_id):
+        return tuple(self._pending.get(group_id) or (0, None))
+
+    def _incr(self, group_id, count, last_seen):
+        self._lock.acquire()
+        try:
+            pending = self._pending.setdefault(group_id, [0, last_seen])
+            pending[0] += count
+            if last_seen > pending[1]:
+                pending[1] = last_seen
+        finally:
+            self._lock.release()
+
+    def _pop_pending(self):
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+        finally:
+            self._lock.release()
+        return pending.iteritems()
+
+class CacheBuffer(BaseBuffer):
+    """
+    Keeps pending changes in the Django cache, which allows any process to
+    read the approximate live counts. Each process only flushes the groups
+    it has incremented itself.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CacheBuffer, self).__init__(*args, **kwargs)
+        self.timeout = max(self.interval * 60, 300)
+        self._group_ids = set()
+
+    def _make_key(self, group_id, name):
+        return 'sentry:buffer:%s:%s' % (group_id, name)
+
+    def get_pending(self, group_id):
+        values = cache.get_many([self._make_key(group_id, 'times_seen'),
+                                 self._make_key(group_id, 'last_seen')])
+        return (values.get(self._make_key(group_id, 'times_seen')) or 0,
+                values.get(self._make_key(group_id, 'last_seen')))
+
+    def _incr(self, group_id, count, last_seen):
+        key = self._make_key(group_id, 'times_seen')
+        if not cache.add(key, count, self.timeout):
+            try:
+                cache.incr(key, count)
+            except ValueError:
+                # The key expired between the add and the incr
+                cache.add(key, count, self.timeout)
+
+        key = self._make_key(group_id, 'last_seen')
+        current = cache.get(key)
+        if not current or last_seen > current:
+            cache.set(key, last_seen, self.timeout)
+
+        self._lock.acquire()
+        try:
+            self._group_ids.add(group_id)
+        finally:
+            self._lock.release()
+
+    def _pop_pending(self):
+        self._lock.acquire()
+        try:
+            group_ids, self._group_ids = self._group_ids, set()
+        finally:
+            self._lock.release()
+
+        for group_id in group_ids:
+            key = self._make_key(group_id, 'times_seen')
+            count = cache.get(key)
+            if not count:
+                continue
+            try:
+                # Decrementing (rather than deleting) preserves any increments
+                # which happened since we read the value
+                cache.decr(key, count)
+            except ValueError:
+                pass
+            yield group_id, (count, cache.get(self._make_key(group_id, 'last_seen')) or datetime.datetime.now())
+
+BUFFERS = {
+    'memory': MemoryBuffer,
+    'cache': CacheBuffer,
+}
+
+_buffer = (None, None)
+def get_buffer():
+    """
+    Returns the counter buffer configured by ``SENTRY_BUFFER``, or ``None``
+    if counters are written synchronously.
+    """
+    global _buffer
+    if _buffer[0] != conf.BUFFER:
+        if _buffer[1] is not None:
+            _buffer[1].flush()
+        if conf.BUFFER:
+            _buffer = (conf.BUFFER, BUFFERS[conf.BUFFER]())
+        else:
+            _buffer = (None, None)
+    return _buffer[1]
+
+def flush_buffer():
+    buffer_ = _buffer[1]
+    if buffer_ is not None:
+        buffer_.flush()
+atexit.register(flush_buffer)
@@ -0,0 +1,132 @@
+"""
+Process-local caches used during ingestion to avoid database round trips for
+data which rarely changes. Each cache can optionally be backed by the Django
+cache (``SENTRY_SHARED_CACHE``) so that processes share what they know.
+"""
+import time
+
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+from sentry import conf
+from sentry.helpers import LRUCache
+
+class TieredCache(object):
+    """
+    A bounded LRU cache local to this process, in front of an optional
+    shared tier stored in the Django cache. ``None`` can not be cached.
+
+    Entries expire ``timeout`` seconds after they were set, however often they
+    are read, which bounds how long another process may keep a stale entry
+    around. With the shared tier, local entries are also dropped as soon as
+    any process calls ``clear``.
+    """
+    def __init__(self, name, size, shared=False, timeout=3600):
+        self.name = name
+        self.shared = shared
+        self.timeout = timeout
+        self.local = LRUCache(size)
+        self.shared_hits = 0
+
+    def _get_version(self):
+        if not self.shared:
+            return None
+        return cache.get(self._make_version_key()) or 0
+
+    def _make_key(self, key, version):
+        return 'sentry:%s:%s:%s' % (self.name, version, md5_constructor(repr(key)).hexdigest())
+
+    def _make_version_key(self):
+        return 'sentry:%s:version' % (self.name,)
+
+    def get(self, key, default=None):
+        now = time.time()
+        version = self._get_version()
+        entry = self.local.get(key)
+        if entry is not None:
+            value, expires, entry_version = entry
+            if expires > now and entry_version == version:
+                return value
+            # Expired, or cleared by another process
+            self.local.delete(key)
+            self.local.hits -= 1
+            self.local.misses += 1
+        if self.shared:
+            value = cache.get(self._make_key(key, version))
+            if value is not None:
+                self.shared_hits += 1
+                self.local.set(key, (value, now + self.timeout, version))
+                return value
+        return default
+
+    def set(self, key, value, shared=True):
+        version = self._get_version()
+        self.local.set(key, (value, time.time() + self.timeout, version))
+        if shared and self.shared:
+            cache.set(self._make_key(key, version), value, self.timeout)
+
+    def update(self, key, value):
+        """
+        Changes the value of a local entry, if there is one, without extending
+        its lifetime.
+        """
+        entry = self.local.get(key)
+        if entry is None:
+            self.local.misses -= 1
+            return
+        # Not a lookup
+        self.local.hits -= 1
+        self.local.set(key, (value,) + entry[1:])
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared:
+            cache.delete(self._make_key(key, self._get_version()))
+
+    def clear(self):
+        self.local.clear()
+        self.shared_hits = 0
+        if self.shared:
+            # Bumping the version orphans every key of the shared tier
+            key = self._make_version_key()
+            if not cache.add(key, 1):
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    cache.set(key, 1)
+
+    def get_stats(self):
+        hits = self.local.hits + self.shared_hits
+        return {
+            'size': len(self.local),
+            'hits': hits,
+            'misses': self.local.misses - self.shared_hits,
+            'local_hits': self.local.hits,
+            'shared_hits': self.shared_hits,
+        }
+
+# Known (key, value) pairs of ``FilterValue``
+filter_values = TieredCache('filtervalue', conf.FILTER_VALUE_CACHE_SIZE, shared=conf.SHARED_CACHE)
+
+# Maps the unique key of a ``GroupedMessage`` to its (pk, times_seen)
+groups = TieredCache('group', conf.GROUP_CACHE_SIZE, shared=conf.SHARED_CACHE)
+
+def get_group_key(message_type, name, checksum, project, test_result=None):
+    key = (message_type, name, checksum, getattr(project, 'pk', project))
+    if message_type == conf.TEST:
+        key += (test_result,)
+    return key
+
+def clear_caches():
+    """
+    Clears all ingestion caches, e.g. after ``cleanup_sentry`` removed data.
+    """
+    filter_values.clear()
+    groups.clear()
+
+def invalidate_filter_value(instance, **kwargs):
+    filter_values.delete((instance.key, instance.value))
+
+def invalidate_group(instance, **kwargs):
+    groups.delete(get_group_key(instance.message_type, instance.name, instance.checksum,
+                                instance.project_id, instance.test_result))
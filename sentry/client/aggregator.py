@@ -0,0 +1,95 @@
+"""
+Collapses identical events on the client.
+
+The first occurrence of an event is sent right away. Copies of it (same
+``class_name`` and checksum) which follow within ``SENTRY_AGGREGATE_INTERVAL``
+seconds are only counted, and sent as a single event carrying ``count``,
+``first_seen`` and ``last_seen`` once the interval is over.
+"""
+import datetime
+import logging
+import threading
+import time
+
+from sentry import conf
+
+logger = logging.getLogger('sentry.errors')
+
+class Aggregator(object):
+    def __init__(self, interval, size=1000):
+        self.interval = interval
+        self.size = size
+        # key -> None while only the first occurrence was seen, or
+        # [client, kwargs, count, first_seen, last_seen]
+        self._open = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def absorb(self, client, key, kwargs):
+        """
+        Returns ``True`` if the event was counted and must not be sent now.
+        """
+        now = datetime.datetime.now()
+        self._lock.acquire()
+        try:
+            if key not in self._open:
+                if len(self._open) < self.size:
+                    self._open[key] = None
+                    self._ensure_thread()
+                return False
+            entry = self._open[key]
+            if entry is None:
+                self._open[key] = [client, kwargs, 1, now, now]
+            else:
+                entry[2] += 1
+                entry[4] = now
+            return True
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        Ends the current interval, sending an event for each one which was
+        repeated during it.
+        """
+        self._lock.acquire()
+        try:
+            entries, self._open = self._open, {}
+        finally:
+            self._lock.release()
+
+        for entry in entries.itervalues():
+            if entry is None:
+                continue
+            client, kwargs, count, first_seen, last_seen = entry
+            try:
+                client.process_aggregated(count=count, first_seen=first_seen, last_seen=last_seen, **kwargs)
+            except Exception, exc:
+                try:
+                    logger.exception(u'Unable to send aggregated event: %s' % (exc,))
+                except Exception:
+                    pass
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.isAlive():
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+_aggregator = (None, None)
+def get_aggregator():
+    global _aggregator
+    if _aggregator[0] != conf.AGGREGATE_INTERVAL:
+        if _aggregator[1] is not None:
+            _aggregator[1].flush()
+        _aggregator = (conf.AGGREGATE_INTERVAL, Aggregator(conf.AGGREGATE_INTERVAL))
+    return _aggregator[1]
+
+def flush_aggregator():
+    if _aggregator[1] is not None:
+        _aggregator[1].flush()
@@ -0,0 +1,309 @@
+"""
+A client for applications running on an asyncio (trollius) event loop.
+
+Events are captured synchronously, so the exception and its frames are still
+around, and then queued. A task on the loop sends them in batches over
+non-blocking keep-alive connections, so the loop never waits on the network.
+"""
+import httplib
+import logging
+import sys
+import urllib
+import urllib2
+import urlparse
+from cStringIO import StringIO
+
+import trollius as asyncio
+from trollius import From, Return
+
+from sentry import conf, wire
+from sentry.client.base import SentryClient, RemotePayload, downgrade_wire_version, get_breaker, \
+                               get_wire_version
+from sentry.http import CircuitOpen
+
+logger = logging.getLogger('sentry.errors')
+
+ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+
+class AsyncHTTPConnection(object):
+    """
+    A keep-alive HTTP/1.1 connection to one host, for one request at a time.
+    """
+    def __init__(self, scheme, netloc, loop=None):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.loop = loop
+        self._reader = self._writer = None
+        self._lock = asyncio.Lock(loop=loop)
+
+    @asyncio.coroutine
+    def request(self, path, body, headers):
+        """
+        POSTs ``body`` to ``path``, returning ``(status, reason, headers,
+        body)`` where ``headers`` is an ``httplib.HTTPMessage``.
+        """
+        with (yield From(self._lock)):
+            reused = self._writer is not None
+            try:
+                result = yield From(self._request(path, body, headers))
+            except (asyncio.IncompleteReadError, EnvironmentError, ValueError):
+                self.close()
+                if not reused:
+                    raise
+                # The server may have closed the connection while it was idle
+                result = yield From(self._request(path, body, headers))
+        raise Return(result)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    @asyncio.coroutine
+    def _connect(self):
+        host, _, port = self.netloc.partition(':')
+        ssl = self.scheme == 'https'
+        if not port:
+            port = ssl and 443 or 80
+        self._reader, self._writer = yield From(asyncio.open_connection(
+            host, int(port), ssl=ssl or None, loop=self.loop))
+
+    @asyncio.coroutine
+    def _request(self, path, body, headers):
+        if self._writer is None:
+            yield From(self._connect())
+        lines = ['POST %s HTTP/1.1' % (path,), 'Host: %s' % (self.netloc,),
+                 'Content-Length: %d' % (len(body),)]
+        lines.extend('%s: %s' % (k, v) for k, v in headers.iteritems())
+        self._writer.write('\r\n'.join(lines) + '\r\n\r\n' + body)
+        yield From(self._writer.drain())
+
+        status_line = yield From(self._reader.readline())
+        if not status_line:
+            raise ValueError('Connection closed by server')
+        version, status, reason = (status_line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+        header_lines = []
+        while True:
+            line = yield From(self._reader.readline())
+            if line in ('\r\n', '\n', ''):
+                break
+            header_lines.append(line)
+        response_headers = httplib.HTTPMessage(StringIO(''.join(header_lines)))
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((yield From(self._reader.readline())).split(';')[0], 16)
+                if not size:
+                    yield From(self._reader.readline())
+                    break
+                chunks.append((yield From(self._reader.readexactly(size))))
+                yield From(self._reader.readline())
+            data = ''.join(chunks)
+            will_close = False
+        elif response_headers.get('content-length') is not None:
+            data = yield From(self._reader.readexactly(int(response_headers['content-length'])))
+            will_close = False
+        else:
+            data = yield From(self._reader.read())
+            will_close = True
+        if will_close or response_headers.get('connection', '').lower() == 'close' \
+           or version == 'HTTP/1.0':
+            self.close()
+        raise Return((int(status), reason, response_headers, data))
+
+class AsyncSentryClient(SentryClient):
+    """
+    ``create_from_exception``, ``create_from_text`` and ``create_from_record``
+    return a future, which completes once the event was sent (or handled as
+    undeliverable)::
+
+        yield From(client.create_from_text('hello'))
+    """
+    def __init__(self, loop=None):
+        self.loop = loop
+        self._queue = None
+        self._task = None
+        self._connections = {}
+        self._pending = set()
+
+    def create_from_record(self, record, **kwargs):
+        return self._as_future(SentryClient.create_from_record(self, record, **kwargs))
+
+    def create_from_text(self, message, **kwargs):
+        return self._as_future(SentryClient.create_from_text(self, message, **kwargs))
+
+    def create_from_exception(self, exc_info=None, **kwargs):
+        # The exception is captured right away, before the loop moves on, and
+        # never handed to SENTRY_EXCEPTION_POOL_SIZE threads as send() must be
+        # called from the loop
+        return self._as_future(self._create_from_exception(exc_info or sys.exc_info(), **kwargs))
+
+    def send_unless_thrashing(self, kwargs, checksum):
+        # The data is normalized before the loop moves on and the caller
+        # changes it, while the thrashing check, which may block on the
+        # cache, runs in an executor
+        kwargs = self.prepare(kwargs)
+        return ensure_future(self._send_unless_thrashing(kwargs, checksum), loop=self._get_loop())
+
+    @asyncio.coroutine
+    def _send_unless_thrashing(self, kwargs, checksum):
+        loop = self._get_loop()
+        if (yield From(loop.run_in_executor(None, self.is_thrashing, kwargs, checksum))):
+            raise Return(None)
+        raise Return((yield From(self.send(**kwargs))))
+
+    def process_aggregated(self, **kwargs):
+        # The aggregator's thread hands the event over to the loop, where
+        # send() must be called
+        self._get_loop().call_soon_threadsafe(lambda: self.process(**kwargs))
+
+    def send(self, **kwargs):
+        loop = self._get_loop()
+        if not conf.REMOTE_URL:
+            from sentry.models import GroupedMessage
+
+            # The database API blocks, so keep it off the loop
+            return loop.run_in_executor(None, lambda: GroupedMessage.objects.from_kwargs(**kwargs))
+
+        queue = self._get_queue()
+        future = asyncio.Future(loop=loop)
+        if queue.full():
+            if conf.REMOTE_QUEUE_POLICY == 'drop_newest':
+                logger.log(kwargs.get('level') or logging.ERROR, kwargs.get('message'))
+                future.set_result(None)
+                return future
+            dropped_kwargs, dropped = queue.get_nowait()
+            logger.log(dropped_kwargs.get('level') or logging.ERROR, dropped_kwargs.get('message'))
+            dropped.set_result(None)
+        queue.put_nowait((kwargs, future))
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Waits until everything queued so far was sent.
+        """
+        if self._pending:
+            yield From(asyncio.wait(list(self._pending), loop=self._get_loop()))
+
+    def _as_future(self, result):
+        if result is None:
+            # Skipped, e.g. by the thrashing limit
+            result = asyncio.Future(loop=self._get_loop())
+            result.set_result(None)
+        return result
+
+    def _get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop
+
+    def _get_queue(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=conf.REMOTE_QUEUE_SIZE, loop=self._get_loop())
+        if self._task is None or self._task.done():
+            self._task = ensure_future(self._run(), loop=self._get_loop())
+        return self._queue
+
+    @asyncio.coroutine
+    def _run(self):
+        loop = self._get_loop()
+        while True:
+            batch = [(yield From(self._queue.get()))]
+            deadline = loop.time() + conf.REMOTE_QUEUE_INTERVAL
+            while len(batch) < conf.REMOTE_QUEUE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append((yield From(asyncio.wait_for(self._queue.get(), timeout, loop=loop))))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                yield From(self._send_batch([kwargs for kwargs, future in batch]))
+            except Exception, exc:
+                logger.exception(u'Unable to send queued events: %s' % (exc,))
+            for kwargs, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    @asyncio.coroutine
+    def _send_batch(self, events):
+        if len(events) == 1:
+            payload = RemotePayload(events[0])
+        else:
+            payload = RemotePayload(events)
+        urls = list(conf.REMOTE_URL)
+        results = yield From(asyncio.gather(*[self._send_to(url, payload) for url in urls],
+                                            loop=self._get_loop(), return_exceptions=True))
+        for url, result in zip(urls, results):
+            if result is not None:
+                # Writes to the spool
+                yield From(self._get_loop().run_in_executor(None, self.send_failed, url,
+                                                            payload.unsent(url), result))
+
+    @asyncio.coroutine
+    def _send_to(self, url, payload):
+        breaker = get_breaker()
+        if not breaker.allow(url):
+            raise CircuitOpen('too many failures, skipped')
+        try:
+            yield From(asyncio.wait_for(self._post(url, payload), conf.REMOTE_TIMEOUT, loop=self._get_loop()))
+        except asyncio.TimeoutError:
+            self._close(url)
+            breaker.failure(url)
+            raise urllib2.URLError('timed out')
+        except (urllib2.URLError, EnvironmentError, asyncio.IncompleteReadError, ValueError), e:
+            self._close(url)
+            breaker.failure(url)
+            if not isinstance(e, urllib2.URLError):
+                e = urllib2.URLError(e)
+            raise e
+        breaker.success(url)
+
+    @asyncio.coroutine
+    def _post(self, url, payload):
+        # Same negotiation as sentry.client.base.send_payload
+        if get_wire_version(url) >= 2:
+            try:
+                yield From(self._request(url, payload.encode(wire.VERSION), {
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Encoding': 'deflate',
+                    'X-Sentry-Version': str(wire.VERSION),
+                    'X-Sentry-Key': conf.KEY,
+                }))
+                return
+            except urllib2.HTTPError, e:
+                if not downgrade_wire_version(url, e):
+                    raise
+        post = payload.encode(1)
+        if not isinstance(post, list):
+            post = [post]
+        for event in post[payload.delivered.get(url, 0):]:
+            yield From(self._request(url, urllib.urlencode(event), {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            }))
+            payload.delivered[url] = payload.delivered.get(url, 0) + 1
+
+    @asyncio.coroutine
+    def _request(self, url, body, headers):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path = '%s?%s' % (path, query)
+        key = (scheme, netloc)
+        if key not in self._connections:
+            self._connections[key] = AsyncHTTPConnection(scheme, netloc, loop=self._get_loop())
+        status, reason, response_headers, data = yield From(
+            self._connections[key].request(path or '/', body, headers))
+        if status >= 400:
+            raise urllib2.HTTPError(url, status, reason, response_headers, StringIO(data))
+        raise Return(data)
+
+    def _close(self, url):
+        scheme, netloc = urlparse.urlsplit(url)[:2]
+        connection = self._connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
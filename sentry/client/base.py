@@ -1,3 +1,4 @@
+import atexit
 import base64
 try:
     import cPickle as pickle
@@ -5,66 +6,167 @@ except ImportError:
     import pickle
 import logging
 import sys
+import time
 import traceback
 import urllib2
+import zlib
 
+from django.conf import settings
 from django.core.cache import cache
 from django.template import TemplateSyntaxError
-from django.utils.encoding import smart_unicode
 from django.views.debug import ExceptionReporter
 
-from sentry import conf
-from sentry.helpers import construct_checksum, varmap, transform, get_installed_apps, urlread
+from sentry import conf, wire
+from sentry.client.aggregator import get_aggregator, flush_aggregator
+from sentry.client.spool import get_spool, start_replayer
+from sentry.helpers import construct_checksum, transform, to_unicode, get_installed_apps, \
+                           CallLimiter, LRUCache, Normalizer, NormalizedDict, PrefixIndex
+from sentry.http import CircuitBreaker, CircuitOpen, RemoteTimeout, ThreadPool, urlread, urlread_many
+from sentry.worker import QueueWorker
 
 logger = logging.getLogger('sentry.errors')
 
 class SentryClient(object):
     def process(self, **kwargs):
-        from sentry.helpers import get_filters
-
         kwargs.setdefault('level', logging.ERROR)
         kwargs.setdefault('server_name', conf.NAME)
 
         checksum = construct_checksum(**kwargs)
 
-        if conf.THRASHING_TIMEOUT and conf.THRASHING_LIMIT:
-            cache_key = 'sentry:%s:%s' % (kwargs.get('class_name') or '', checksum)
-            added = cache.add(cache_key, 1, conf.THRASHING_TIMEOUT)
-            try:
-                if not added and cache.incr(cache_key) > conf.THRASHING_LIMIT:
-                    return
-            except KeyError:
-                pass
+        # Repeats of a recent event are only counted, and sent later as one
+        if conf.AGGREGATE_INTERVAL and 'count' not in kwargs:
+            if get_aggregator().absorb(self, (kwargs.get('class_name') or '', checksum), kwargs):
+                return
+
+        return self.send_unless_thrashing(kwargs, checksum)
+
+    def send_unless_thrashing(self, kwargs, checksum):
+        """
+        Prepares and sends the event, unless ``is_thrashing``.
+        """
+        if self.is_thrashing(kwargs, checksum):
+            return
+        return self.send(**self.prepare(kwargs))
+
+    def is_thrashing(self, kwargs, checksum):
+        """
+        Returns ``True`` if the event was sent more than ``SENTRY_THRASHING_LIMIT``
+        times within the current ``SENTRY_THRASHING_TIMEOUT`` seconds.
+        """
+        if not (conf.THRASHING_TIMEOUT and conf.THRASHING_LIMIT):
+            return False
+        # Counted in fixed windows, so that the count of this process is
+        # part of the count in the cache for the same window
+        window = int(time.time() // conf.THRASHING_TIMEOUT)
+        cache_key = 'sentry:%s:%s:%s' % (kwargs.get('class_name') or '', checksum, window)
+        # Once this process alone has gone over the limit the cache would
+        # refuse as well, so there's no need to ask it
+        if conf.THRASHING_LOCAL_SIZE and not get_thrashing_limiter().consume(cache_key):
+            return True
+        added = cache.add(cache_key, 1, conf.THRASHING_TIMEOUT)
+        try:
+            if not added and cache.incr(cache_key) > conf.THRASHING_LIMIT:
+                return True
+        except KeyError:
+            pass
+        return False
+
+    def prepare(self, kwargs):
+        """
+        Applies the filters to the event and normalizes its data.
+        """
+        from sentry.helpers import get_filters
 
         for filter_ in get_filters():
             kwargs = filter_(None).process(kwargs) or kwargs
         
         # Make sure all additional data is coerced
         if 'data' in kwargs:
-            kwargs['data'] = transform(kwargs['data'])
+            data = transform(kwargs['data'])
+            if isinstance(data, dict):
+                # Not walked again when stored
+                data = NormalizedDict(data)
+            kwargs['data'] = data
+        return kwargs
 
-        return self.send(**kwargs)
+    def process_aggregated(self, **kwargs):
+        """
+        Processes an event collapsed by the aggregator, which calls it from
+        its own thread.
+        """
+        return self.process(**kwargs)
 
     def send(self, **kwargs):
         if conf.REMOTE_URL:
-            for url in conf.REMOTE_URL:
-                data = {
-                    'data': base64.b64encode(pickle.dumps(kwargs).encode('zlib')),
-                    'key': conf.KEY,
-                }
-                try:
-                    urlread(url, post=data, timeout=conf.REMOTE_TIMEOUT)
-                except urllib2.URLError, e:
-                    logger.error('Unable to reach Sentry log server: %s' % (e,), exc_info=sys.exc_info(), extra={'remote_url': url})
-                    logger.log(kwargs.pop('level', None) or logging.ERROR, kwargs.pop('message', None))
-                except urllib2.HTTPError, e:
-                    logger.error('Unable to reach Sentry log server: %s' % (e,), exc_info=sys.exc_info(), extra={'body': e.read(), 'remote_url': url})
-                    logger.log(kwargs.pop('level', None) or logging.ERROR, kwargs.pop('message', None))
+            if conf.REMOTE_QUEUE:
+                if not get_remote_queue().put(kwargs):
+                    logger.log(kwargs.get('level') or logging.ERROR, kwargs.get('message'))
+                return
+            self.send_remote(kwargs)
         else:
             from sentry.models import GroupedMessage
             
             return GroupedMessage.objects.from_kwargs(**kwargs)
 
+    def send_batch(self, events):
+        """
+        Sends a list of events at once, as a single request to each of
+        ``SENTRY_REMOTE_URL`` or a single transaction.
+        """
+        if conf.REMOTE_URL:
+            self.send_remote(events)
+        else:
+            from sentry.models import GroupedMessage
+
+            return GroupedMessage.objects.from_kwargs_batch(events)
+
+    def send_remote(self, payload):
+        """
+        POSTs ``payload`` to each of ``SENTRY_REMOTE_URL`` concurrently.
+        ``payload`` is either a single event or a list of events.
+
+        Returns a dict mapping each url to ``None``, or to the exception which
+        sending to it failed with. Requests which are still under way at the
+        deadline (``RemoteTimeout``) are handled once they finish.
+        """
+        remote = RemotePayload(payload)
+
+        def on_late(url, e):
+            if e is not None:
+                self.send_failed(url, remote.unsent(url), e)
+
+        results = urlread_many(conf.REMOTE_URL, deadline=conf.REMOTE_DEADLINE, breaker=get_breaker(),
+                               func=send_payload, on_late=on_late, payload=remote)
+        for url in conf.REMOTE_URL:
+            if results[url] is not None and not isinstance(results[url], RemoteTimeout):
+                self.send_failed(url, remote.unsent(url), results[url])
+        if conf.SPOOL_PATH:
+            start_replayer()
+        return results
+
+    def send_failed(self, url, payload, e):
+        """
+        Called when ``payload`` could not be sent to ``url``: spools it if
+        ``SENTRY_SPOOL_PATH`` is set, and logs it locally otherwise.
+        """
+        if isinstance(e, urllib2.HTTPError):
+            logger.error('Unable to reach Sentry log server: %s' % (e,), extra={'body': e.read(), 'remote_url': url})
+        elif not isinstance(e, CircuitOpen):
+            logger.error('Unable to reach Sentry log server: %s' % (e,), extra={'remote_url': url})
+        if conf.SPOOL_PATH:
+            try:
+                get_spool().append(url, payload)
+            except Exception, exc:
+                logger.error('Unable to write to Sentry spool: %s' % (exc,), exc_info=sys.exc_info())
+            else:
+                return
+        if isinstance(payload, list):
+            events = payload
+        else:
+            events = [payload]
+        for event in events:
+            logger.log(event.get('level') or logging.ERROR, event.get('message'))
+
     def create_from_record(self, record, **kwargs):
         """
         Creates an error log for a `logging` module `record` instance.
@@ -98,6 +200,10 @@ class SentryClient(object):
         if record.exc_info and all(record.exc_info):
             return self.create_from_exception(record.exc_info, **kwargs)
 
+        # Set by QueuedSentryHandler, which formats the exception beforehand
+        if getattr(record, 'exc_class_name', None):
+            kwargs.setdefault('class_name', record.exc_class_name)
+
         return self.process(
             traceback=record.exc_text,
             **kwargs
@@ -115,84 +221,52 @@ class SentryClient(object):
     def create_from_exception(self, exc_info=None, **kwargs):
         """
         Creates an error log from an exception.
+
+        With ``SENTRY_EXCEPTION_POOL_SIZE`` set, only a snapshot of the
+        traceback is taken here, and the event is built and sent by a
+        background thread. ``None`` is returned in that case, as when the
+        event is sent to a remote server.
         """
         if not exc_info:
             exc_info = sys.exc_info()
+        if conf.EXCEPTION_POOL_SIZE:
+            pool = get_exception_pool()
+            # When the threads can't keep up, fall back to doing the work here
+            if pool.queue.qsize() < conf.EXCEPTION_QUEUE_SIZE:
+                exc_type, exc_value, exc_traceback = exc_info
+                exc_info = (exc_type, exc_value, snapshot_traceback(exc_traceback))
+                pool.apply_async(self._create_from_exception, exc_info, **kwargs)
+                return None
+        return self._create_from_exception(exc_info, **kwargs)
+
+    def _create_from_exception(self, exc_info, **kwargs):
         exc_type, exc_value, exc_traceback = exc_info
 
-        def to_unicode(f):
-            if isinstance(f, dict):
-                nf = dict()
-                for k, v in f.iteritems():
-                    nf[str(k)] = to_unicode(v)
-                f = nf
-            elif isinstance(f, (list, tuple)):
-                f = [to_unicode(f) for f in f]
-            else:
-                try:
-                    f = smart_unicode(f)
-                except (UnicodeEncodeError, UnicodeDecodeError):
-                    f = '(Error decoding value)'
-                except Exception: # in some cases we get a different exception
-                    f = smart_unicode(type(f))
-            return f
-
-        def shorten(var):
-            if not isinstance(var, basestring):
-                var = to_unicode(var)
-            if len(var) > 200:
-                var = var[:200] + '...'
-            return var
-
-        reporter = ExceptionReporter(None, exc_type, exc_value, exc_traceback)
-        frames = varmap(shorten, reporter.get_traceback_frames())
+        normalizer = Normalizer(max_length=200)
+        reporter = BudgetExceptionReporter(None, exc_type, exc_value, exc_traceback)
+        frames = []
+        for frame in reporter.get_traceback_frames():
+            # Variables were already normalized by the reporter
+            variables = frame.pop('vars', None)
+            frame = normalizer.normalize(frame)
+            if variables is not None:
+                frame['vars'] = variables
+            frames.append(frame)
 
         if not kwargs.get('view'):
-            # This should be cached
-            modules = get_installed_apps()
-            if conf.INCLUDE_PATHS:
-                modules = set(list(modules) + conf.INCLUDE_PATHS)
-
-            def iter_tb_frames(tb):
-                while tb:
-                    yield tb.tb_frame
-                    tb = tb.tb_next
-            
-            def contains(iterator, value):
-                for k in iterator:
-                    if value.startswith(k):
-                        return True
-                return False
-                
-            # We iterate through each frame looking for an app in INSTALLED_APPS
-            # When one is found, we mark it as last "best guess" (best_guess) and then
-            # check it against SENTRY_EXCLUDE_PATHS. If it isnt listed, then we
-            # use this option. If nothing is found, we use the "best guess".
-            best_guess = None
-            view = None
-            for frame in iter_tb_frames(exc_traceback):
-                view = '.'.join([frame.f_globals['__name__'], frame.f_code.co_name])
-                if contains(modules, view):
-                    if not (contains(conf.EXCLUDE_PATHS, view) and best_guess):
-                        best_guess = view
-                elif best_guess:
-                    break
-            if best_guess:
-                view = best_guess
-            
+            view = get_view_resolver().resolve(exc_traceback)
             if view:
                 kwargs['view'] = view
 
         data = kwargs.pop('data', {}) or {}
-        data['__sentry__'] = {
-            'exc': map(to_unicode, [exc_type.__class__.__module__, exc_value.args, frames]),
-        }
+        # Not walked again by process()
+        data['__sentry__'] = NormalizedDict(
+            exc=[to_unicode(exc_type.__class__.__module__), transform(exc_value.args), frames],
+        )
 
         if isinstance(exc_value, TemplateSyntaxError) and hasattr(exc_value, 'source'):
             origin, (start, end) = exc_value.source
-            data['__sentry__'].update({
-                'template': (origin.reload(), start, end, origin.name),
-            })
+            data['__sentry__']['template'] = transform((origin.reload(), start, end, origin.name))
             kwargs['view'] = origin.loadname
         
         tb_message = '\n'.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
@@ -206,3 +280,336 @@ class SentryClient(object):
             **kwargs
         )
 
+class FrameSnapshot(object):
+    """
+    Stands in for a traceback entry once the exception was handled, holding
+    what ``BudgetExceptionReporter``, ``ViewResolver`` and the ``traceback``
+    module read from it. Instead of the local variables, it holds
+    ``variables`` as the reporter returns them, normalized when the snapshot
+    was taken.
+    """
+    def __init__(self, tb, variables=None):
+        frame = tb.tb_frame
+        self.tb_frame = self
+        self.tb_lineno = tb.tb_lineno
+        self.tb_next = None
+        self.f_code = frame.f_code
+        self.f_locals = {}
+        if frame.f_locals.get('__traceback_hide__'):
+            self.f_locals['__traceback_hide__'] = True
+        self.f_globals = dict([(k, frame.f_globals[k]) for k in ('__name__', '__loader__')
+                               if k in frame.f_globals])
+        self.variables = variables
+
+def snapshot_traceback(tb):
+    """
+    Returns a chain of ``FrameSnapshot`` for the traceback ``tb``. The local
+    variables of the frames ``BudgetExceptionReporter`` reports are
+    normalized right away, as they may change, or only be readable from this
+    thread, once the exception was handled.
+    """
+    reporter = BudgetExceptionReporter(None, None, None, tb)
+    reporter.normalizer = reporter.get_normalizer()
+    reported = set([id(t) for t in reporter.get_reported_tracebacks()[0]])
+
+    head = last = None
+    while tb is not None:
+        variables = None
+        if id(tb) in reported:
+            variables = reporter.get_variables(tb)
+        snapshot = FrameSnapshot(tb, variables)
+        if last is None:
+            head = snapshot
+        else:
+            last.tb_next = snapshot
+        last = snapshot
+        tb = tb.tb_next
+    return head
+
+class BudgetExceptionReporter(ExceptionReporter):
+    """
+    Collects frames like Django's ``ExceptionReporter``, within the limits of
+    ``SENTRY_MAX_FRAMES``, ``SENTRY_MAX_VARIABLES``, ``SENTRY_MAX_REPR_LENGTH``
+    and ``SENTRY_MAX_CAPTURE_SIZE``. Nothing is read or converted for the
+    frames and variables which don't fit, and local variables are returned
+    already normalized.
+    """
+    max_depth = 3
+
+    def get_normalizer(self):
+        return Normalizer(max_length=conf.MAX_REPR_LENGTH, max_items=conf.MAX_VARIABLES,
+                          max_depth=self.max_depth, max_size=conf.MAX_CAPTURE_SIZE or None)
+
+    def get_reported_tracebacks(self):
+        """
+        Returns ``(tbs, outer, omitted)``: the traceback entries to report,
+        the index before which ``omitted`` frames were left out (or
+        ``None``), and their number.
+        """
+        tbs = []
+        tb = self.tb
+        while tb is not None:
+            # support for __traceback_hide__ which is used by a few libraries
+            # to hide internal frames.
+            if not tb.tb_frame.f_locals.get('__traceback_hide__'):
+                tbs.append(tb)
+            tb = tb.tb_next
+
+        omitted = 0
+        if conf.MAX_FRAMES and len(tbs) > conf.MAX_FRAMES:
+            # The outermost frames show how we got there, the innermost ones
+            # what went wrong; the middle of a deep stack is the least useful
+            outer = conf.MAX_FRAMES // 2
+            inner = conf.MAX_FRAMES - outer
+            omitted = len(tbs) - conf.MAX_FRAMES
+            tbs = tbs[:outer] + tbs[-inner:]
+        else:
+            outer = None
+        return tbs, outer, omitted
+
+    def get_variables(self, tb):
+        """
+        Returns the normalized ``[name, value]`` pairs of the local variables
+        of ``tb``, within the limits.
+        """
+        if isinstance(tb, FrameSnapshot):
+            return tb.variables or []
+        variables = []
+        for k, v in tb.tb_frame.f_locals.iteritems():
+            if self.normalizer.exhausted or (conf.MAX_VARIABLES and len(variables) >= conf.MAX_VARIABLES):
+                break
+            variables.append([self.normalizer.normalize(k), self.normalizer.normalize(v)])
+        return variables
+
+    def get_traceback_frames(self):
+        self.normalizer = self.get_normalizer()
+        tbs, outer, omitted = self.get_reported_tracebacks()
+
+        frames = []
+        for i, tb in enumerate(tbs):
+            if i == outer:
+                frames.append({
+                    'filename': '',
+                    'function': '(%d frames omitted)' % (omitted,),
+                    'lineno': '?',
+                    'context_line': '...',
+                })
+            frame = self._get_frame(tb)
+            if frame is not None:
+                frames.append(frame)
+
+        if not frames:
+            frames = [{
+                'filename': '&lt;unknown&gt;',
+                'function': '?',
+                'lineno': '?',
+                'context_line': '???',
+            }]
+
+        return frames
+
+    def _get_frame(self, tb):
+        filename = tb.tb_frame.f_code.co_filename
+        function = tb.tb_frame.f_code.co_name
+        lineno = tb.tb_lineno - 1
+        loader = tb.tb_frame.f_globals.get('__loader__')
+        module_name = tb.tb_frame.f_globals.get('__name__')
+        pre_context_lineno, pre_context, context_line, post_context = self._get_lines_from_file(filename, lineno, 7, loader, module_name)
+        if pre_context_lineno is None:
+            return None
+
+        variables = self.get_variables(tb)
+
+        return {
+            'tb': tb,
+            'filename': filename,
+            'function': function,
+            'lineno': lineno + 1,
+            'vars': variables,
+            'id': id(tb),
+            'pre_context': pre_context,
+            'context_line': context_line,
+            'post_context': post_context,
+            'pre_context_lineno': pre_context_lineno + 1,
+        }
+
+class ViewResolver(object):
+    """
+    Finds the view (``module.function``) an exception is attributed to.
+    Frames of ``modules`` count, unless they match ``exclude`` and a better
+    candidate was already found. What's known about each code object is
+    remembered, so deep stacks are cheap to resolve once they've been seen.
+    """
+    def __init__(self, modules, exclude, size=1000):
+        self.modules = PrefixIndex(modules)
+        self.exclude = PrefixIndex(exclude)
+        self._frames = LRUCache(size)
+
+    def resolve(self, tb):
+        # We iterate through each frame looking for an app in INSTALLED_APPS
+        # When one is found, we mark it as last "best guess" (best_guess) and then
+        # check it against SENTRY_EXCLUDE_PATHS. If it isnt listed, then we
+        # use this option. If nothing is found, we use the "best guess".
+        best_guess = None
+        view = None
+        while tb:
+            view, included, excluded = self._lookup(tb.tb_frame)
+            if included:
+                if not (excluded and best_guess):
+                    best_guess = view
+            elif best_guess:
+                break
+            tb = tb.tb_next
+        return best_guess or view
+
+    def _lookup(self, frame):
+        key = (frame.f_globals.get('__name__'), frame.f_code)
+        result = self._frames.get(key)
+        if result is None:
+            view = '.'.join([frame.f_globals['__name__'], frame.f_code.co_name])
+            result = (view, view in self.modules, view in self.exclude)
+            self._frames.set(key, result)
+        return result
+
+_resolver = (None, None)
+def get_view_resolver():
+    global _resolver
+    options = (tuple(settings.INSTALLED_APPS), tuple(conf.INCLUDE_PATHS or ()), tuple(conf.EXCLUDE_PATHS or ()))
+    if _resolver[0] != options:
+        modules = list(get_installed_apps()) + list(conf.INCLUDE_PATHS or ())
+        _resolver = (options, ViewResolver(modules, conf.EXCLUDE_PATHS or ()))
+    return _resolver[1]
+
+def send_queued_events(events):
+    from sentry.client.models import get_client
+
+    get_client().send_remote(events)
+
+class RemotePayload(object):
+    """
+    An event (or list of events), encoded at most once per wire format.
+
+    Servers which only understand version 1 store a single event per
+    request, so a list of events is encoded as a list of requests for them,
+    and ``delivered`` counts those each url already accepted.
+    """
+    def __init__(self, payload):
+        self.payload = payload
+        self.delivered = {}
+        self._encoded = {}
+
+    def encode(self, version):
+        if version not in self._encoded:
+            if version >= 2:
+                self._encoded[version] = zlib.compress(wire.encode(self.payload))
+            elif isinstance(self.payload, list):
+                self._encoded[version] = [self._encode_legacy(e) for e in self.payload]
+            else:
+                self._encoded[version] = self._encode_legacy(self.payload)
+        return self._encoded[version]
+
+    def unsent(self, url):
+        """
+        Returns what ``url`` has yet to receive.
+        """
+        if isinstance(self.payload, list) and self.delivered.get(url):
+            return self.payload[self.delivered[url]:]
+        return self.payload
+
+    def _encode_legacy(self, payload):
+        return {
+            'data': base64.b64encode(pickle.dumps(payload).encode('zlib')),
+            'key': conf.KEY,
+        }
+
+# Servers which didn't understand the current wire format
+_legacy_urls = set()
+
+def get_wire_version(url):
+    """
+    Returns the version of the wire format to send to ``url`` in.
+    """
+    if conf.WIRE_VERSION >= 2 and url not in _legacy_urls:
+        return wire.VERSION
+    return 1
+
+def downgrade_wire_version(url, e):
+    """
+    Returns ``True`` if the ``HTTPError`` ``e`` means ``url`` doesn't
+    understand the current wire format, which it isn't sent anymore.
+    """
+    # Servers which know about versions always say which one they use
+    if e.code >= 500 or e.hdrs.get('X-Sentry-Version'):
+        return False
+    _legacy_urls.add(url)
+    return True
+
+def send_payload(url, payload):
+    """
+    POSTs ``payload`` (a ``RemotePayload``) to ``url`` in the most recent wire
+    format the server supports.
+    """
+    if get_wire_version(url) >= 2:
+        try:
+            return urlread(url, data=payload.encode(wire.VERSION), headers={
+                'Content-Type': 'application/octet-stream',
+                'Content-Encoding': 'deflate',
+                'X-Sentry-Version': str(wire.VERSION),
+                'X-Sentry-Key': conf.KEY,
+            }, timeout=conf.REMOTE_TIMEOUT)
+        except urllib2.HTTPError, e:
+            if not downgrade_wire_version(url, e):
+                raise
+    post = payload.encode(1)
+    if isinstance(post, list):
+        for event in post[payload.delivered.get(url, 0):]:
+            urlread(url, post=event, timeout=conf.REMOTE_TIMEOUT)
+            payload.delivered[url] = payload.delivered.get(url, 0) + 1
+        return
+    return urlread(url, post=post, timeout=conf.REMOTE_TIMEOUT)
+
+_limiter = (None, None)
+def get_thrashing_limiter():
+    global _limiter
+    options = (conf.THRASHING_LIMIT, conf.THRASHING_LOCAL_SIZE)
+    if _limiter[0] != options:
+        _limiter = (options, CallLimiter(*options))
+    return _limiter[1]
+
+_breaker = None
+def get_breaker():
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(conf.REMOTE_FAILURE_THRESHOLD, conf.REMOTE_COOLDOWN)
+    return _breaker
+
+_exception_pool = None
+def get_exception_pool():
+    global _exception_pool
+    if _exception_pool is None:
+        _exception_pool = ThreadPool(conf.EXCEPTION_POOL_SIZE)
+    return _exception_pool
+
+def flush_exception_pool():
+    if _exception_pool is not None:
+        _exception_pool.join()
+
+_remote_queue = None
+def get_remote_queue():
+    global _remote_queue
+    if _remote_queue is None:
+        _remote_queue = QueueWorker(send_queued_events,
+            interval=conf.REMOTE_QUEUE_INTERVAL,
+            batch_size=conf.REMOTE_QUEUE_BATCH_SIZE,
+            maxsize=conf.REMOTE_QUEUE_SIZE,
+            policy=conf.REMOTE_QUEUE_POLICY,
+        )
+    return _remote_queue
+
+def flush_remote_queue():
+    if _remote_queue is not None:
+        _remote_queue.flush()
+atexit.register(flush_remote_queue)
+# Registered last so they run first, while events can still be queued
+atexit.register(flush_aggregator)
+atexit.register(flush_exception_pool)
@@ -1,7 +1,36 @@
+import atexit
+import logging
+
 from sentry.client.base import SentryClient
-from sentry.client.celery import tasks
+from sentry.client.celery import conf, tasks
+from sentry.worker import QueueWorker
+
+logger = logging.getLogger('sentry.errors')
 
 class CelerySentryClient(SentryClient):
     def send(self, **kwargs):
         "Errors through celery"
-        tasks.send.delay(kwargs)
\ No newline at end of file
+        if conf.CELERY_BATCH_SIZE > 1:
+            if not get_celery_queue().put(kwargs):
+                logger.log(kwargs.get('level') or logging.ERROR, kwargs.get('message'))
+            return
+        tasks.send.delay(kwargs)
+
+def publish_batch(events):
+    tasks.send_batch.delay(events)
+
+_celery_queue = None
+def get_celery_queue():
+    global _celery_queue
+    if _celery_queue is None:
+        _celery_queue = QueueWorker(publish_batch,
+            interval=conf.CELERY_BATCH_INTERVAL,
+            batch_size=conf.CELERY_BATCH_SIZE,
+            maxsize=conf.CELERY_QUEUE_SIZE,
+        )
+    return _celery_queue
+
+def flush_celery_queue():
+    if _celery_queue is not None:
+        _celery_queue.flush()
+atexit.register(flush_celery_queue)
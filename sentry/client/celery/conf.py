@@ -1,3 +1,10 @@
 from django.conf import settings
 
-CELERY_ROUTING_KEY = getattr(settings, 'SENTRY_CELERY_ROUTING_KEY', 'sentry')
\ No newline at end of file
+CELERY_ROUTING_KEY = getattr(settings, 'SENTRY_CELERY_ROUTING_KEY', 'sentry')
+
+# Number of events published as a single task, 1 to publish every event on its own
+CELERY_BATCH_SIZE = getattr(settings, 'SENTRY_CELERY_BATCH_SIZE', 1)
+# Seconds to wait for a batch to fill up before publishing it anyway
+CELERY_BATCH_INTERVAL = getattr(settings, 'SENTRY_CELERY_BATCH_INTERVAL', 1.0)
+# Number of events waiting to be published before new ones are dropped
+CELERY_QUEUE_SIZE = getattr(settings, 'SENTRY_CELERY_QUEUE_SIZE', 1000)
@@ -5,3 +5,7 @@ from sentry.client.celery import conf
 @task(routing_key=conf.CELERY_ROUTING_KEY)
 def send(data):
     return SentryClient().send(**data)
+
+@task(routing_key=conf.CELERY_ROUTING_KEY)
+def send_batch(events):
+    return SentryClient().send_batch(events)
@@ -1,14 +1,97 @@
+import copy
 import logging
 import sys
+import traceback
+
+from sentry.worker import QueueWorker
+
+logger = logging.getLogger('sentry.errors')
 
 class SentryHandler(logging.Handler):
     def emit(self, record):
-        from sentry.client.models import get_client
-
         # Avoid typical config issues by overriding loggers behavior
         if record.name == 'sentry.errors':
             print >> sys.stderr, "Recursive log message sent to SentryHandler"
             print >> sys.stderr, record.message
             return
 
-        get_client().create_from_record(record)
\ No newline at end of file
+        self.send(record)
+
+    def send(self, record):
+        from sentry.client.models import get_client
+
+        get_client().create_from_record(record)
+
+class QueuedSentryHandler(SentryHandler):
+    """
+    Like ``SentryHandler``, but the logging thread only copies the record,
+    with its message and exception already formatted. Records are sent by a
+    background thread, and new ones are dropped (and counted in ``dropped``)
+    while ``queue_size`` records are waiting.
+
+    As the traceback is gone by the time the record is sent, the local
+    variables of its frames are not captured.
+    """
+    def __init__(self, queue_size=1000, level=logging.NOTSET):
+        SentryHandler.__init__(self, level)
+        self.worker = QueueWorker(self.send_records, interval=0, maxsize=queue_size)
+        self._reported = 0
+
+    @property
+    def dropped(self):
+        return self.worker.dropped
+
+    def send(self, record):
+        self.worker.put(self.prepare(record))
+
+    def prepare(self, record):
+        """
+        Returns a copy of ``record`` which no longer refers to anything that
+        may change or go away once the logging call returns.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info and all(record.exc_info):
+            exc_type, exc_value, exc_traceback = record.exc_info
+            record.exc_text = '\n'.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+            record.exc_class_name = exc_type.__name__
+        record.exc_info = None
+
+        request = getattr(record, 'request', None)
+        if request:
+            data = dict(record.__dict__.get('data') or {})
+            data.update(dict(
+                META=request.META,
+                POST=request.POST,
+                GET=request.GET,
+                COOKIES=request.COOKIES,
+            ))
+            record.data = data
+            if not record.__dict__.get('url'):
+                record.url = request.build_absolute_uri()
+            record.request = None
+        return record
+
+    def send_records(self, records):
+        for record in records:
+            try:
+                SentryHandler.send(self, record)
+            except Exception, exc:
+                try:
+                    logger.exception(u'Unable to send log record: %s' % (exc,))
+                except Exception:
+                    pass
+
+        dropped = self.dropped
+        if dropped != self._reported:
+            logger.warning(u'Log queue is full, dropped %d record(s)' % (dropped - self._reported,))
+            self._reported = dropped
+
+    def flush(self):
+        self.worker.flush()
+
+    def close(self):
+        self.flush()
+        SentryHandler.close(self)
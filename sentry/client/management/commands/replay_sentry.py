@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sentry import conf
+from sentry.client.spool import replay_spool
+
+class Command(BaseCommand):
+    help = 'Sends events spooled while the Sentry server was unreachable.'
+
+    def handle(self, *args, **options):
+        if not conf.SPOOL_PATH:
+            raise CommandError('SENTRY_SPOOL_PATH is not set.')
+        print 'Sent %d spooled event(s).' % (replay_spool(),)
@@ -0,0 +1,310 @@
+"""
+An append-only spool on local disk for events which could not be delivered
+to ``SENTRY_REMOTE_URL``.
+
+Events are appended to segment files in ``SENTRY_SPOOL_PATH`` as records of a
+4 byte big-endian length followed by the zlib compressed, pickled
+``(url, payload)``. Once a segment reaches ``SENTRY_SPOOL_SEGMENT_SIZE`` a new
+one is started, and the oldest segments are deleted when the spool grows
+beyond ``SENTRY_SPOOL_MAX_SIZE``.
+
+Segments are sent again (and removed) by a background thread every
+``SENTRY_SPOOL_REPLAY_INTERVAL`` seconds, or by the ``replay_sentry``
+management command.
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib2
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sentry import conf
+
+logger = logging.getLogger('sentry.errors')
+
+HEADER = struct.Struct('>I')
+SUFFIX = '.spool'
+
+def _lock(fp, blocking=True):
+    if fcntl is None:
+        return True
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(fp.fileno(), flags)
+    except IOError:
+        return False
+    return True
+
+def _unlock(fp):
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+class Spool(object):
+    def __init__(self, path, segment_size=1024 * 1024, max_size=50 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.dropped = 0
+        self._started = False
+        self._lock = threading.Lock()
+
+    def append(self, url, payload):
+        """
+        Writes an event (or a list of events) which should be sent to ``url``.
+        """
+        data = zlib.compress(pickle.dumps((url, payload), pickle.HIGHEST_PROTOCOL))
+        self._acquire()
+        try:
+            segments = self.segments()
+            if not segments:
+                size = None
+            else:
+                size = os.path.getsize(segments[-1])
+            # The first write of this process starts a new segment, so records
+            # never follow one left half written by a process which crashed
+            if size is None or size >= self.segment_size or (size and not self._started):
+                segment = self._new_segment(segments)
+                segments.append(segment)
+            else:
+                segment = segments[-1]
+            self._started = True
+            fp = open(segment, 'ab')
+            try:
+                # A single write, so a concurrent reader never sees half a header
+                fp.write(HEADER.pack(len(data)) + data)
+            finally:
+                fp.close()
+            self._enforce_max_size(segments)
+        finally:
+            self._release()
+
+    def segments(self):
+        """
+        Returns the paths of all segments, oldest first.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return [os.path.join(self.path, n) for n in sorted(names) if n.endswith(SUFFIX)]
+
+    def read(self, segment):
+        """
+        Returns the ``(url, payload)`` records stored in ``segment``. A record
+        which was only partially written is ignored.
+        """
+        fp = open(segment, 'rb')
+        try:
+            size = os.fstat(fp.fileno()).st_size
+            if not size:
+                return []
+            buf = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                records = []
+                offset = 0
+                while offset + HEADER.size <= size:
+                    length, = HEADER.unpack(buf[offset:offset + HEADER.size])
+                    offset += HEADER.size
+                    if offset + length > size:
+                        break
+                    try:
+                        records.append(pickle.loads(zlib.decompress(buf[offset:offset + length])))
+                    except Exception, exc:
+                        logger.warning(u'Skipping unreadable record in %s: %s' % (segment, exc))
+                    offset += length
+                return records
+            finally:
+                buf.close()
+        finally:
+            fp.close()
+
+    def replay(self, send):
+        """
+        Calls ``send(url, payload)`` for every spooled record, removing those
+        which were sent. ``send`` returns ``False`` (or raises) on failure, in
+        which case the remaining records for that url are kept for later.
+
+        Returns the number of records which were sent.
+        """
+        self._acquire()
+        try:
+            segments = self.segments()
+            # Start a new segment so that the ones we replay are no longer written to
+            if segments and os.path.getsize(segments[-1]):
+                segments.append(self._new_segment(segments))
+        finally:
+            self._release()
+
+        sent = 0
+        failed = set()
+        for segment in segments[:-1]:
+            try:
+                fp = open(segment, 'rb+')
+            except IOError:
+                # Removed by another process
+                continue
+            try:
+                if not _lock(fp, blocking=False):
+                    # Being replayed by another process
+                    continue
+                try:
+                    if os.stat(segment).st_ino != os.fstat(fp.fileno()).st_ino:
+                        # Rewritten by another process since we opened it
+                        continue
+                except OSError:
+                    continue
+                remaining = []
+                for url, payload in self.read(segment):
+                    if url not in failed:
+                        try:
+                            ok = send(url, payload) is not False
+                        except Exception, exc:
+                            logger.warning(u'Unable to replay spooled event to %s: %s' % (url, exc))
+                            ok = False
+                        if ok:
+                            sent += 1
+                            continue
+                        failed.add(url)
+                    remaining.append((url, payload))
+                if remaining:
+                    self._rewrite(segment, remaining)
+                else:
+                    try:
+                        os.unlink(segment)
+                    except OSError:
+                        # Removed by another process, e.g. when over max size
+                        pass
+            finally:
+                fp.close()
+        return sent
+
+    def _new_segment(self, segments):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if segments:
+            number = int(os.path.basename(segments[-1])[:-len(SUFFIX)]) + 1
+        else:
+            number = 0
+        segment = os.path.join(self.path, '%020d%s' % (number, SUFFIX))
+        open(segment, 'ab').close()
+        return segment
+
+    def _rewrite(self, segment, records):
+        tmp = segment + '.tmp'
+        fp = open(tmp, 'wb')
+        try:
+            for record in records:
+                data = zlib.compress(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+                fp.write(HEADER.pack(len(data)) + data)
+        finally:
+            fp.close()
+        os.rename(tmp, segment)
+
+    def _enforce_max_size(self, segments):
+        sizes = [os.path.getsize(s) for s in segments]
+        total = sum(sizes)
+        # Never remove the segment currently written to
+        while total > self.max_size and len(segments) > 1:
+            segment = segments.pop(0)
+            total -= sizes.pop(0)
+            try:
+                os.unlink(segment)
+            except OSError:
+                pass
+            self.dropped += 1
+            logger.warning(u'Spool is over %d bytes, removed %s' % (self.max_size, segment))
+
+    def _acquire(self):
+        # Serialize segment rotation between threads as well as processes
+        self._lock.acquire()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._lock_fp = open(os.path.join(self.path, 'lock'), 'ab')
+        _lock(self._lock_fp)
+
+    def _release(self):
+        try:
+            _unlock(self._lock_fp)
+            self._lock_fp.close()
+        finally:
+            self._lock.release()
+
+def send_spooled(url, payload):
+    from sentry.client.base import RemotePayload, get_breaker, send_payload
+
+    breaker = get_breaker()
+    if not breaker.allow(url):
+        return False
+    remote = RemotePayload(payload)
+    try:
+        send_payload(url, remote)
+    except urllib2.URLError:
+        breaker.failure(url)
+        if remote.unsent(url) is payload:
+            return False
+        # Only spool again the events the server didn't get
+        get_spool().append(url, remote.unsent(url))
+        return True
+    breaker.success(url)
+    return True
+
+def replay_spool():
+    """
+    Sends everything in ``SENTRY_SPOOL_PATH``, returning the number of spooled
+    records which were delivered.
+    """
+    return get_spool().replay(send_spooled)
+
+class Replayer(threading.Thread):
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                replay_spool()
+            except Exception, exc:
+                try:
+                    logger.exception(u'Unable to replay spool: %s' % (exc,))
+                except Exception:
+                    pass
+
+_spool = None
+def get_spool():
+    global _spool
+    if _spool is None:
+        _spool = Spool(conf.SPOOL_PATH, conf.SPOOL_SEGMENT_SIZE, conf.SPOOL_MAX_SIZE)
+    return _spool
+
+_replayer = None
+_replayer_lock = threading.Lock()
+def start_replayer():
+    global _replayer
+    if not conf.SPOOL_REPLAY_INTERVAL:
+        return
+    if _replayer is not None and _replayer.isAlive():
+        return
+    _replayer_lock.acquire()
+    try:
+        if _replayer is None or not _replayer.isAlive():
+            _replayer = Replayer(conf.SPOOL_REPLAY_INTERVAL)
+            _replayer.start()
+    finally:
+        _replayer_lock.release()
@@ -15,6 +15,48 @@ if DATABASE_USING:
 
 THRASHING_TIMEOUT = getattr(settings, 'SENTRY_THRASHING_TIMEOUT', 60)
 THRASHING_LIMIT = getattr(settings, 'SENTRY_THRASHING_LIMIT', 10)
+# Seconds during which repeats of an event are counted instead of sent, 0 to
+# send every event
+AGGREGATE_INTERVAL = getattr(settings, 'SENTRY_AGGREGATE_INTERVAL', 0)
+
+# Number of messages each process tracks itself before asking the shared cache
+THRASHING_LOCAL_SIZE = getattr(settings, 'SENTRY_THRASHING_LOCAL_SIZE', 1000)
+
+# Buffer ``times_seen``/``last_seen`` updates instead of writing them for every
+# event. Either ``'memory'`` (per process) or ``'cache'`` (Django cache).
+BUFFER = getattr(settings, 'SENTRY_BUFFER', None)
+
+# How often, in seconds, buffered counters are written to the database
+BUFFER_INTERVAL = getattr(settings, 'SENTRY_BUFFER_INTERVAL', 10)
+
+# Once a message has been seen SAMPLE_THRESHOLD times only one in every 10
+# events is stored, one in every 100 past ten times the threshold, and so on.
+# Counters stay exact. Set to 0 to store every event.
+SAMPLE_THRESHOLD = getattr(settings, 'SENTRY_SAMPLE_THRESHOLD', 0)
+
+# Overrides SAMPLE_THRESHOLD per logger name (including child loggers) or level
+SAMPLE_THRESHOLDS = getattr(settings, 'SENTRY_SAMPLE_THRESHOLDS', {})
+
+# Cap the messages stored per group to the first KEEP_FIRST_MESSAGES and the
+# most recent KEEP_LAST_MESSAGES. Set KEEP_LAST_MESSAGES to 0 to keep them all.
+KEEP_FIRST_MESSAGES = getattr(settings, 'SENTRY_KEEP_FIRST_MESSAGES', 10)
+KEEP_LAST_MESSAGES = getattr(settings, 'SENTRY_KEEP_LAST_MESSAGES', 0)
+
+# Groups are trimmed every TRIM_INTERVAL occurrences, removing at most
+# TRIM_BATCH_SIZE messages at a time
+TRIM_INTERVAL = getattr(settings, 'SENTRY_TRIM_INTERVAL', 100)
+TRIM_BATCH_SIZE = getattr(settings, 'SENTRY_TRIM_BATCH_SIZE', 500)
+
+# Number of filter values each process remembers as already stored, which
+# saves a ``get_or_create`` per event. Set to 0 to disable.
+FILTER_VALUE_CACHE_SIZE = getattr(settings, 'SENTRY_FILTER_VALUE_CACHE_SIZE', 1000)
+
+# Number of groups each process remembers the primary key of, which saves a
+# ``get_or_create`` for events of a known group. Set to 0 to disable.
+GROUP_CACHE_SIZE = getattr(settings, 'SENTRY_GROUP_CACHE_SIZE', 1000)
+
+# Share what the ingestion caches know between processes using the Django cache
+SHARED_CACHE = getattr(settings, 'SENTRY_SHARED_CACHE', False)
 
 ANY, LOG, TEST = 0, 1, 2
 ANY_LABEL, LOG_LABEL, TEST_LABEL = None, 'Log', 'Test'
@@ -53,8 +95,57 @@ if REMOTE_URL:
 
 REMOTE_TIMEOUT = getattr(settings, 'SENTRY_REMOTE_TIMEOUT', 5)
 
+# With several REMOTE_URLs, the longest to wait for all of them to answer
+REMOTE_DEADLINE = getattr(settings, 'SENTRY_REMOTE_DEADLINE', REMOTE_TIMEOUT)
+# Number of threads sending to several REMOTE_URLs at once, shared by the
+# whole process
+REMOTE_POOL_SIZE = getattr(settings, 'SENTRY_REMOTE_POOL_SIZE', 10)
+
+# Skip a REMOTE_URL for REMOTE_COOLDOWN seconds after this many failures in a row
+REMOTE_FAILURE_THRESHOLD = getattr(settings, 'SENTRY_REMOTE_FAILURE_THRESHOLD', 5)
+REMOTE_COOLDOWN = getattr(settings, 'SENTRY_REMOTE_COOLDOWN', 30)
+
+# Directory to keep events in which could not be sent to REMOTE_URL, so they
+# can be sent again later. Disabled unless set.
+SPOOL_PATH = getattr(settings, 'SENTRY_SPOOL_PATH', None)
+SPOOL_SEGMENT_SIZE = getattr(settings, 'SENTRY_SPOOL_SEGMENT_SIZE', 1024 * 1024)
+SPOOL_MAX_SIZE = getattr(settings, 'SENTRY_SPOOL_MAX_SIZE', 50 * 1024 * 1024)
+# Seconds between attempts to send spooled events, 0 to only use replay_sentry
+SPOOL_REPLAY_INTERVAL = getattr(settings, 'SENTRY_SPOOL_REPLAY_INTERVAL', 60)
+
+# Seconds before an unused keep-alive connection to a remote host is closed
+HTTP_IDLE_TIMEOUT = getattr(settings, 'SENTRY_HTTP_IDLE_TIMEOUT', 60)
+
+# Version of the format events are sent to REMOTE_URL in. Version 2 (JSON) is
+# used with servers which support it, version 1 (pickle) otherwise.
+WIRE_VERSION = getattr(settings, 'SENTRY_WIRE_VERSION', 2)
+
+# Whether the store view accepts events in the original, pickled format. As
+# unpickling data can run arbitrary code, disable this once all clients
+# send version 2.
+ACCEPT_PICKLE = getattr(settings, 'SENTRY_ACCEPT_PICKLE', True)
+
+# Largest (decompressed) request body the store view accepts, in bytes
+MAX_STORE_SIZE = getattr(settings, 'SENTRY_MAX_STORE_SIZE', 10 * 1024 * 1024)
+
+# Send events to REMOTE_URL from a background thread, several per request
+REMOTE_QUEUE = getattr(settings, 'SENTRY_REMOTE_QUEUE', False)
+REMOTE_QUEUE_SIZE = getattr(settings, 'SENTRY_REMOTE_QUEUE_SIZE', 1000)
+REMOTE_QUEUE_INTERVAL = getattr(settings, 'SENTRY_REMOTE_QUEUE_INTERVAL', 1.0)
+REMOTE_QUEUE_BATCH_SIZE = getattr(settings, 'SENTRY_REMOTE_QUEUE_BATCH_SIZE', 100)
+# Either 'drop_oldest' or 'drop_newest'
+REMOTE_QUEUE_POLICY = getattr(settings, 'SENTRY_REMOTE_QUEUE_POLICY', 'drop_oldest')
+
 ADMINS = getattr(settings, 'SENTRY_ADMINS', [])
 
+# Send admin mail from a background thread rather than while storing events.
+# New messages seen within the digest window are combined into one mail.
+MAIL_QUEUE = getattr(settings, 'SENTRY_MAIL_QUEUE', False)
+MAIL_DIGEST_WINDOW = getattr(settings, 'SENTRY_MAIL_DIGEST_WINDOW', 10)
+
+# Minimum number of seconds between two mails about the same message
+MAIL_THROTTLE = getattr(settings, 'SENTRY_MAIL_THROTTLE', 0)
+
 # TODO: deprecate this
 USE_LOGGING = getattr(settings, 'SENTRY_USE_LOGGING', False)
 
@@ -78,6 +169,22 @@ SITE = getattr(settings, 'SENTRY_SITE', None)
 # discover which function an error comes from (typically a view)
 EXCLUDE_PATHS = getattr(settings, 'SENTRY_EXCLUDE_PATHS', [])
 
+# Limits on what is captured from the stack of an exception. The innermost
+# and outermost frames are kept, and values are cut at MAX_REPR_LENGTH
+# characters. Once MAX_CAPTURE_SIZE characters of local variables were
+# captured, no more are collected.
+MAX_FRAMES = getattr(settings, 'SENTRY_MAX_FRAMES', 50)
+MAX_VARIABLES = getattr(settings, 'SENTRY_MAX_VARIABLES', 100)
+MAX_REPR_LENGTH = getattr(settings, 'SENTRY_MAX_REPR_LENGTH', 200)
+MAX_CAPTURE_SIZE = getattr(settings, 'SENTRY_MAX_CAPTURE_SIZE', 256 * 1024)
+
+# Number of threads which build and send events for exceptions, 0 to do it in
+# the thread which caught the exception
+EXCEPTION_POOL_SIZE = getattr(settings, 'SENTRY_EXCEPTION_POOL_SIZE', 0)
+# Number of exceptions waiting for a thread before new ones are handled in the
+# thread which caught them
+EXCEPTION_QUEUE_SIZE = getattr(settings, 'SENTRY_EXCEPTION_QUEUE_SIZE', 1000)
+
 # By default Sentry only looks at modules in INSTALLED_APPS for drilling down
 # where an exception is located
 INCLUDE_PATHS = getattr(settings, 'SENTRY_INCLUDE_PATHS', [])
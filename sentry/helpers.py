@@ -1,9 +1,15 @@
+import bisect
+import datetime
+import decimal
 import logging
+import math
+import threading
 import urllib
 import urllib2
 
 import django
 from django.conf import settings
+from django.utils.encoding import smart_unicode
 from django.utils.hashcompat import md5_constructor
 
 from sentry import conf
@@ -48,6 +54,15 @@ def construct_checksum(level=logging.ERROR, class_name='', traceback='', message
     checksum.update(message)
     return checksum.hexdigest()
 
+def get_sample_rate(times_seen, threshold):
+    """
+    Returns ``n`` where only one in every ``n`` occurrences of a message which
+    has been seen ``times_seen`` times should be stored.
+    """
+    if not threshold or times_seen <= threshold:
+        return 1
+    return 10 ** int(math.log10(float(times_seen) / threshold) + 1)
+
 def varmap(func, var):
     if isinstance(var, dict):
         return dict((k, varmap(func, v)) for k, v in var.iteritems())
@@ -56,16 +71,137 @@ def varmap(func, var):
     else:
         return func(var)
 
+def to_unicode(value):
+    try:
+        return smart_unicode(value)
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return u'(Error decoding value)'
+    except Exception: # in some cases we get a different exception
+        return smart_unicode(type(value))
+
+# Types which are stored and sent as they are
+PRIMITIVE_TYPES = (type(None), bool, int, long, float, decimal.Decimal,
+                   datetime.datetime, datetime.date, datetime.time)
+
+_type_handlers = {}
+_handler_cache = {}
+
+def register_type(type_, func):
+    """
+    Makes ``Normalizer`` replace values of ``type_`` (or of a subclass) with
+    ``func(value)``, which is then normalized in turn::
+
+        register_type(uuid.UUID, lambda value: value.hex)
+    """
+    _type_handlers[type_] = func
+    _handler_cache.clear()
+
+def _get_type_handler(cls):
+    try:
+        return _handler_cache[cls]
+    except KeyError:
+        handler = None
+        for base in getattr(cls, '__mro__', (cls,)):
+            if base in _type_handlers:
+                handler = _type_handlers[base]
+                break
+        _handler_cache[cls] = handler
+        return handler
+
+class NormalizedDict(dict):
+    """
+    A dict of values which were normalized already, which ``Normalizer``
+    keeps as it is. It is pickled as a plain dict.
+    """
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+class Normalizer(object):
+    """
+    Turns a value into one which can be stored and sent, in a single walk:
+    unicode strings, numbers, booleans, ``None``, dates, and dicts and lists
+    of those. Types given to ``register_type`` are converted first, and
+    anything else ends up as unicode.
+
+    Strings are cut after ``max_length`` characters, containers after
+    ``max_items`` items, and containers nested deeper than ``max_depth`` are
+    converted to unicode as a whole. Once ``max_size`` characters were
+    produced (over every call) the remaining values are replaced by ``...``.
+    A container found within itself is replaced by ``<recursion>``, and a
+    ``NormalizedDict`` is not walked again.
+    """
+    def __init__(self, max_length=None, max_items=None, max_depth=None, max_size=None):
+        self.max_length = max_length
+        self.max_items = max_items
+        self.max_depth = max_depth
+        self.remaining = max_size
+        # The containers we're currently within
+        self._path = set()
+
+    @property
+    def exhausted(self):
+        return self.remaining is not None and self.remaining <= 0
+
+    def normalize(self, value, depth=0):
+        if type(value) is NormalizedDict:
+            return value
+        if self.exhausted:
+            return u'...'
+        handler = _get_type_handler(type(value))
+        if handler is not None:
+            return self.normalize(handler(value), depth)
+        if isinstance(value, PRIMITIVE_TYPES):
+            return value
+        if isinstance(value, basestring):
+            return self._text(value)
+
+        is_dict = isinstance(value, dict)
+        if not is_dict and not isinstance(value, (list, tuple, set, frozenset)):
+            return self._text(value)
+        if self.max_depth is not None and depth >= self.max_depth:
+            return self._text(value)
+        if id(value) in self._path:
+            return u'<recursion>'
+
+        self._path.add(id(value))
+        try:
+            if is_dict:
+                result = {}
+                for k, v in value.iteritems():
+                    if self._full(result):
+                        break
+                    if not isinstance(k, basestring):
+                        k = to_unicode(k)
+                    result[k] = self.normalize(v, depth + 1)
+            else:
+                result = []
+                for v in value:
+                    if self._full(result):
+                        break
+                    result.append(self.normalize(v, depth + 1))
+        finally:
+            self._path.discard(id(value))
+        return result
+
+    def _full(self, result):
+        return self.exhausted or (self.max_items and len(result) >= self.max_items)
+
+    def _text(self, value):
+        if isinstance(value, basestring) and self.max_length:
+            # Don't decode more than will be kept
+            value = value[:self.max_length + 1]
+        value = to_unicode(value)
+        if self.max_length and len(value) > self.max_length:
+            value = value[:self.max_length] + u'...'
+        if self.remaining is not None:
+            self.remaining -= len(value)
+        return value
+
 def transform(value):
-    # TODO: make this extendable
-    # TODO: include some sane defaults, like UUID
-    if isinstance(value, (tuple, list)):
-        return [transform(o) for o in value]
-    elif isinstance(value, dict):
-        return dict((k, transform(v)) for k, v in value.iteritems())
-    elif not isinstance(value, (int, bool, basestring)) and value is not None:
-        return unicode(type(value))
-    return value
+    """
+    Normalizes ``value`` without any limits.
+    """
+    return Normalizer().normalize(value)
 
 def get_installed_apps():
     """
@@ -76,6 +212,127 @@ def get_installed_apps():
         out.add(app)
     return out
 
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping which discards the least recently used
+    key once it holds more than ``size`` keys. Lookups are counted in
+    ``hits`` and ``misses``.
+    """
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.hits = self.misses = 0
+            self._data = {}
+            # The most recently used key is always at the head of a circular,
+            # doubly linked list of [prev, next, key, value]
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None]
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._push(link)
+            return link[self.VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[self.VALUE] = value
+            else:
+                link = self._data[key] = [None, None, key, value]
+            self._push(link)
+            while len(self._data) > self.size:
+                oldest = self._root[self.PREV]
+                self._unlink(oldest)
+                del self._data[oldest[self.KEY]]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            link = self._data.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def _push(self, link):
+        root = self._root
+        link[self.PREV], link[self.NEXT] = root, root[self.NEXT]
+        root[self.NEXT][self.PREV] = link
+        root[self.NEXT] = link
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+class PrefixIndex(object):
+    """
+    Tells whether a string starts with any of ``prefixes`` in ``O(log n)``.
+    """
+    def __init__(self, prefixes):
+        # Drop prefixes which are covered by a shorter one, so that the only
+        # candidate for a match is the closest prefix sorting before a value
+        self._prefixes = []
+        for prefix in sorted(set(prefixes)):
+            if not (self._prefixes and prefix.startswith(self._prefixes[-1])):
+                self._prefixes.append(prefix)
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self._prefixes, value)
+        return bool(i) and value.startswith(self._prefixes[i - 1])
+
+class CallLimiter(object):
+    """
+    Allows up to ``limit`` calls to ``consume`` for each key. Only the
+    ``size`` most recently used keys are tracked, so keys are meant to
+    include the time window they are limited for.
+    """
+    def __init__(self, limit, size=1000):
+        self.limit = limit
+        self._counts = LRUCache(size)
+        self._lock = threading.Lock()
+
+    def consume(self, key):
+        """
+        Counts a call for ``key``, returning ``False`` if it went over the
+        limit.
+        """
+        self._lock.acquire()
+        try:
+            count = self._counts.get(key, 0) + 1
+            self._counts.set(key, count)
+            return count <= self.limit
+        finally:
+            self._lock.release()
+
 class _Missing(object):
 
     def __repr__(self):
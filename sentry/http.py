@@ -0,0 +1,389 @@
+"""
+HTTP requests over persistent connections.
+
+Each thread keeps one keep-alive connection per remote host, so sending many
+events to the same server doesn't pay for a new TCP (and SSL) handshake every
+time. Connections which have been idle for longer than
+``SENTRY_HTTP_IDLE_TIMEOUT`` seconds are closed, and a request which fails on
+a reused connection is retried once on a fresh one.
+
+``urlread_many`` sends the same request to several hosts at once, skipping
+hosts which keep failing for a while.
+"""
+import Queue
+import httplib
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from cStringIO import StringIO
+
+from sentry import conf
+
+class ConnectionPool(object):
+    def __init__(self, idle_timeout=60):
+        self.idle_timeout = idle_timeout
+        self._local = threading.local()
+
+    def request(self, url, body=None, headers={}, timeout=None):
+        """
+        Sends a request to ``url`` (a POST when ``body`` is given) and returns
+        the response body.
+
+        Raises ``urllib2.HTTPError`` for error responses and
+        ``urllib2.URLError`` when the host can't be reached, like
+        ``urllib2.urlopen``.
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if scheme not in ('http', 'https'):
+            raise urllib2.URLError('unsupported scheme: %s' % (scheme,))
+        if query:
+            path = '%s?%s' % (path, query)
+        headers = dict(headers)
+        if body is not None and 'Content-Type' not in headers:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        method = body is None and 'GET' or 'POST'
+
+        key = (scheme, netloc)
+        conn, reused = self._get_connection(key, timeout)
+        try:
+            try:
+                response = self._send(conn, method, path or '/', body, headers)
+            except (httplib.HTTPException, socket.error):
+                self._discard(key)
+                if not reused:
+                    raise
+                # The server may have closed the connection while it was idle
+                conn, reused = self._get_connection(key, timeout)
+                response = self._send(conn, method, path or '/', body, headers)
+        except (httplib.HTTPException, socket.error), e:
+            self._discard(key)
+            raise urllib2.URLError(e)
+
+        status, reason, response_headers, data, will_close = response
+        if will_close:
+            self._discard(key)
+        else:
+            self._connections[key] = (conn, time.time())
+
+        if status >= 400:
+            raise urllib2.HTTPError(url, status, reason, response_headers, StringIO(data))
+        return data
+
+    def close(self):
+        """
+        Closes all connections held by the calling thread.
+        """
+        for key in self._connections.keys():
+            self._discard(key)
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        # The response must be read in full before the connection is reused
+        data = response.read()
+        return response.status, response.reason, response.msg, data, response.will_close
+
+    @property
+    def _connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            self._local.connections = {}
+            return self._local.connections
+
+    def _get_connection(self, key, timeout):
+        connections = self._connections
+        now = time.time()
+        for other_key, (conn, last_used) in connections.items():
+            if now - last_used > self.idle_timeout:
+                self._discard(other_key)
+        if key in connections:
+            return connections[key][0], True
+
+        scheme, netloc = key
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        try:
+            conn = cls(netloc, timeout=timeout)
+        except TypeError:
+            # Python 2.5 has no per connection timeout
+            conn = cls(netloc)
+        connections[key] = (conn, now)
+        return conn, False
+
+    def _discard(self, key):
+        conn, last_used = self._connections.pop(key, (None, None))
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+class RemoteTimeout(urllib2.URLError):
+    """
+    The host did not answer before the deadline. The request carries on, and
+    its outcome is passed to the ``on_late`` callback of ``urlread_many``.
+    """
+
+class NotSent(urllib2.URLError):
+    """
+    The request was still waiting for a thread at the deadline, and was
+    dropped without being sent.
+    """
+
+class CircuitOpen(urllib2.URLError):
+    """
+    The host was skipped as it failed too many times in a row.
+    """
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failures per host. Once a host has failed
+    ``threshold`` times it is skipped for ``cooldown`` seconds, after which a
+    single request is let through to find out whether it recovered.
+    """
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        self._lock.acquire()
+        try:
+            count, retry_at = self._failures.get(key, (0, 0))
+            if count < self.threshold:
+                return True
+            now = time.time()
+            if now < retry_at:
+                return False
+            # Let this request probe the host, and hold back the others
+            self._failures[key] = (count, now + self.cooldown)
+            return True
+        finally:
+            self._lock.release()
+
+    def success(self, key):
+        self._lock.acquire()
+        try:
+            self._failures.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def failure(self, key):
+        self._lock.acquire()
+        try:
+            count, retry_at = self._failures.get(key, (0, 0))
+            count += 1
+            if count >= self.threshold:
+                retry_at = time.time() + self.cooldown
+            self._failures[key] = (count, retry_at)
+        finally:
+            self._lock.release()
+
+class AsyncResult(object):
+    def __init__(self):
+        self.value = None
+        self.exception = None
+        self.started = False
+        self.cancelled = False
+        self._callback = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def wait(self, timeout=None):
+        self._ready.wait(timeout)
+        return self._ready.isSet()
+
+    def cancel(self):
+        """
+        Prevents the call from starting, returning ``False`` if it already
+        did.
+        """
+        self._lock.acquire()
+        try:
+            if self.started:
+                return False
+            self.cancelled = True
+            return True
+        finally:
+            self._lock.release()
+
+    def set_callback(self, func):
+        """
+        Calls ``func(result)`` once the call finished, right away if it
+        already did.
+        """
+        self._lock.acquire()
+        try:
+            if not self._ready.isSet():
+                self._callback = func
+                return
+        finally:
+            self._lock.release()
+        func(self)
+
+class ThreadPool(object):
+    """
+    A fixed number of daemon threads calling the functions given to
+    ``apply_async``.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def apply_async(self, func, *args, **kwargs):
+        self._ensure_threads()
+        result = AsyncResult()
+        self.queue.put((result, func, args, kwargs))
+        return result
+
+    def _ensure_threads(self):
+        self._lock.acquire()
+        try:
+            self._threads = [t for t in self._threads if t.isAlive()]
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._run)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def join(self):
+        """
+        Waits until every function given so far has been called.
+        """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            result, func, args, kwargs = self.queue.get()
+            result._lock.acquire()
+            try:
+                result.started = not result.cancelled
+            finally:
+                result._lock.release()
+            if result.started:
+                try:
+                    result.value = func(*args, **kwargs)
+                except Exception:
+                    result.exception = sys.exc_info()[1]
+
+            result._lock.acquire()
+            try:
+                result._ready.set()
+                callback = result._callback
+            finally:
+                result._lock.release()
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception:
+                    pass
+            self.queue.task_done()
+
+_pool = None
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(idle_timeout=conf.HTTP_IDLE_TIMEOUT)
+    return _pool
+
+def urlread(url, get={}, post={}, headers={}, timeout=None, data=None):
+    """
+    Like ``sentry.helpers.urlread``, but over a pooled connection. ``data``
+    may be given to send a body which is already encoded, instead of
+    ``post``.
+    """
+    if get:
+        url = '%s%s%s' % (url, '?' in url and '&' or '?', urllib.urlencode(get))
+    if data is None and post:
+        data = urllib.urlencode(post)
+    return get_pool().request(url, data, headers=headers, timeout=timeout)
+
+_thread_pool = None
+def get_thread_pool():
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPool(conf.REMOTE_POOL_SIZE)
+    return _thread_pool
+
+def urlread_many(urls, deadline=None, breaker=None, func=urlread, on_late=None, **kwargs):
+    """
+    Calls ``func`` (``urlread`` by default) for each of ``urls``
+    concurrently, waiting at most ``deadline`` seconds for all of them to
+    finish.
+
+    Returns a dict mapping each url to ``None`` if it succeeded, or to the
+    exception it failed with: ``CircuitOpen`` when ``breaker`` skipped it,
+    ``NotSent`` when no thread was free to send it before the deadline, and
+    ``RemoteTimeout`` when it was sent but did not finish in time. In the
+    last case ``on_late(url, exception)`` is called once it does finish,
+    with ``None`` if it succeeded.
+
+    Only hosts which were actually sent to are reported to ``breaker``.
+    """
+    results = {}
+    pending = []
+    for url in urls:
+        if breaker is not None and not breaker.allow(url):
+            results[url] = CircuitOpen('too many failures, skipped')
+        else:
+            pending.append(url)
+
+    late = []
+    if len(pending) == 1:
+        # Nothing to wait for concurrently
+        url = pending[0]
+        try:
+            func(url, **kwargs)
+        except urllib2.URLError, e:
+            results[url] = e
+        else:
+            results[url] = None
+    elif pending:
+        pool = get_thread_pool()
+        async_results = [(url, pool.apply_async(func, url, **kwargs)) for url in pending]
+        if deadline is not None:
+            deadline += time.time()
+        for url, result in async_results:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - time.time())
+            if result.wait(timeout):
+                results[url] = result.exception
+            elif result.cancel():
+                # Only waited for a thread, which says nothing about the host
+                results[url] = NotSent('no thread was free before the deadline')
+            else:
+                results[url] = RemoteTimeout('no response within the deadline')
+                late.append((url, result))
+
+    if breaker is not None:
+        for url in pending:
+            if results[url] is None:
+                breaker.success(url)
+            elif not isinstance(results[url], (NotSent, RemoteTimeout)):
+                breaker.failure(url)
+
+    for url, result in late:
+        def finished(result, url=url):
+            if breaker is not None:
+                if result.exception is None:
+                    breaker.success(url)
+                else:
+                    breaker.failure(url)
+            if on_late is not None:
+                on_late(url, result.exception)
+        result.set_callback(finished)
+    return results
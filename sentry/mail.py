@@ -0,0 +1,48 @@
+"""
+Delivery of admin mail for new messages.
+
+With ``SENTRY_MAIL_QUEUE`` enabled mail is sent from a background thread
+instead of the ingestion path, and messages which appear within the same
+``SENTRY_MAIL_DIGEST_WINDOW`` are combined into a single digest.
+"""
+import atexit
+
+from django.core.cache import cache
+
+from sentry import conf
+from sentry.worker import QueueWorker
+
+def notify_admins(group):
+    """
+    Mails ``SENTRY_ADMINS`` about ``group``, unless a mail about it was
+    already sent within the last ``SENTRY_MAIL_THROTTLE`` seconds.
+    """
+    if not conf.ADMINS:
+        return
+    if conf.MAIL_THROTTLE and not cache.add('sentry:mail:%s' % (group.pk,), 1, conf.MAIL_THROTTLE):
+        return
+    if conf.MAIL_QUEUE:
+        get_mail_queue().put(group.pk)
+    else:
+        group.mail_admins()
+
+def send_queued_mail(group_ids):
+    from sentry.models import GroupedMessage
+
+    groups = list(GroupedMessage.objects.filter(pk__in=set(group_ids)).order_by('-last_seen'))
+    if len(groups) == 1:
+        groups[0].mail_admins()
+    elif groups:
+        GroupedMessage.mail_admins_digest(groups)
+
+_mail_queue = None
+def get_mail_queue():
+    global _mail_queue
+    if _mail_queue is None:
+        _mail_queue = QueueWorker(send_queued_mail, interval=conf.MAIL_DIGEST_WINDOW)
+    return _mail_queue
+
+def flush_mail_queue():
+    if _mail_queue is not None:
+        _mail_queue.flush()
+atexit.register(flush_mail_queue)
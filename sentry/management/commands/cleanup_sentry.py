@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand
 
+from sentry import conf
+from sentry.caches import clear_caches
 from sentry.models import Message, GroupedMessage
 
 from optparse import make_option
@@ -26,3 +28,11 @@ class Command(BaseCommand):
         
         GroupedMessage.objects.filter(last_seen__lte=ts, **base_kwargs).delete()
         Message.objects.filter(datetime__lte=ts, **base_kwargs).delete()
+
+        # Catch up on groups which were not trimmed while storing messages
+        if conf.KEEP_LAST_MESSAGES:
+            for group in GroupedMessage.objects.filter(times_seen__gt=conf.KEEP_FIRST_MESSAGES + conf.KEEP_LAST_MESSAGES, **base_kwargs):
+                group.trim_messages()
+
+        # Make sure ingestion doesn't rely on anything we just removed
+        clear_caches()
@@ -1,13 +1,19 @@
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 import datetime
 import django
 import logging
 import warnings
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import signals
+from django.utils.datastructures import SortedDict
 
 from sentry import conf
-from sentry.helpers import construct_checksum
+from sentry.helpers import construct_checksum, get_db_engine, get_filters, get_sample_rate
+from sentry.mail import notify_admins
 
 assert not conf.DATABASE_USING or django.VERSION >= (1, 2), 'The `SENTRY_DATABASE_USING` setting requires Django >= 1.2'
 
@@ -23,64 +29,23 @@ class SentryManager(models.Manager):
         return qs
 
     def from_kwargs(self, **kwargs):
-        from sentry.models import Message, GroupedMessage, FilterValue
-        URL_MAX_LENGTH = Message._meta.get_field_by_name('url')[0].max_length
-
-        name = kwargs.pop('name', None)
-        message_type = kwargs.pop("message_type", conf.LOG)
-        project = kwargs.pop("project")
-
-        site = kwargs.pop('site', None)
-        test_result = kwargs.pop('test_result', None)
-
-        # Log specific
-        logger_name = kwargs.pop('logger', '')
-        url = kwargs.pop('url', None)
-        data = kwargs.pop('data', {}) or {}
-        if url:
-            data['url'] = url
-            url = url[:URL_MAX_LENGTH]
+        from sentry.models import Message
 
-        checksum = construct_checksum(**kwargs)
+        event = self._pop_event_kwargs(kwargs)
         mail = False
         try:
-            if 'url' in data:
-                kwargs['data'] = {'url': data['url']}
-            group, created = self._get_or_create_group_message(message_type, name,
-                                                               checksum, project,
-                                                               test_result, kwargs)
-            kwargs.pop('data', None)
-            if not created:
-                self._update_counters(group)
-            else: 
+            group, created = self._record_group(event, self._get_group_defaults(event, kwargs),
+                                                count=event['count'], last_seen=event['last_seen'])
+            if created:
                 mail = True
 
-            instance = Message.objects.create(
-                name=name,
-                message_type=message_type,
-                project=project,
-                checksum=checksum,
-                group=group,
-
-                logger=logger_name,
-                data=data,
-                url=url,
-                site=site,
-                test_result=test_result,
-                **kwargs
-            )
-            if site:
-                print FilterValue.objects.all()
-                
-                FilterValue.objects.get_or_create(key='site__servername', value=site.servername, label=site.servername)
-#            if site:
-#                FilterValue.objects.get_or_create(key='site', value=site.id, label=site.name)
-            if site:
-                FilterValue.objects.get_or_create(key='project', value=project.id, label=project.name)
-            if logger_name:
-                FilterValue.objects.get_or_create(key='logger', value=logger_name, label=logger_name)
-            if test_result:
-                FilterValue.objects.get_or_create(key='test_result', value=test_result, label=test_result)
+            if self._should_store(group.times_seen, event, kwargs):
+                instance = Message.objects.create(group=group, **self._get_message_kwargs(event, kwargs))
+                self._maybe_trim(group, event['count'])
+            else:
+                instance = None
+            for key, value, label in self._get_filter_values(event):
+                self._record_filter_value(key, value, label)
         except Exception, exc:
             # TODO: should we mail admins when there are failures?
             try:
@@ -89,9 +54,342 @@ class SentryManager(models.Manager):
                 warnings.warn(u'Unable to process log entry: %s' % (exc,))
         else:
             if mail:
-                group.mail_admins()
+                notify_admins(group)
             return instance
 
+    def from_kwargs_batch(self, events):
+        """
+        Stores a list of events, each one being the keyword arguments you
+        would pass to ``from_kwargs``, within a single transaction.
+
+        Events are grouped in memory on (message_type, name, checksum, project)
+        so that each distinct group is only upserted once, with ``times_seen``
+        and ``last_seen`` aggregated over the whole batch (including the
+        ``count`` of events which were collapsed by the client).
+
+        Returns the list of ``Message`` instances which were stored.
+        """
+        pending = SortedDict()
+        for kwargs in events:
+            kwargs = dict(kwargs)
+            event = self._pop_event_kwargs(kwargs)
+            key = (event['message_type'], event['name'], event['checksum'], event['project'])
+            if event['message_type'] == conf.TEST:
+                key += (event['test_result'],)
+            pending.setdefault(key, []).append((event, kwargs))
+
+        if conf.DATABASE_USING:
+            store_batch = transaction.commit_on_success(using=conf.DATABASE_USING)(self._store_batch)
+        else:
+            store_batch = transaction.commit_on_success(self._store_batch)
+        # Groups are only cached once the transaction was committed
+        to_cache = []
+        try:
+            groups, instances = store_batch(pending.values(), to_cache)
+        except Exception, exc:
+            try:
+                logger.exception(u'Unable to process log entries: %s' % (exc,))
+            except Exception, exc:
+                warnings.warn(u'Unable to process log entries: %s' % (exc,))
+            return []
+
+        if self._use_group_cache():
+            from sentry.caches import groups as group_cache
+
+            for key, value in to_cache:
+                group_cache.set(key, value)
+
+        for group, created in groups:
+            if created:
+                notify_admins(group)
+        return instances
+
+    def _store_batch(self, batches, to_cache):
+        from sentry.models import Message
+
+        groups = []
+        counts = []
+        instances = []
+        filter_values = SortedDict()
+        for batch in batches:
+            event, kwargs = batch[0]
+            last_seen = max([e['last_seen'] or k.get('datetime') or datetime.datetime.now() for e, k in batch])
+            count = sum([e['count'] for e, k in batch])
+            group, created = self._record_group(event, self._get_group_defaults(event, kwargs),
+                                                count=count, last_seen=last_seen, to_cache=to_cache)
+            groups.append((group, created))
+            counts.append(count)
+
+            times_seen = group.times_seen - count
+            for event, kwargs in batch:
+                times_seen += event['count']
+                if self._should_store(times_seen, event, kwargs):
+                    instances.append(Message(group=group, **self._get_message_kwargs(event, kwargs)))
+                for key, value, label in self._get_filter_values(event):
+                    filter_values[(key, value)] = label
+
+        # Indexed filters rely on the post_save signal of each message
+        if django.VERSION < (1, 2) or [f for f in get_filters() if f.column.startswith('data__')]:
+            for instance in instances:
+                instance.save()
+        else:
+            Message.objects.bulk_insert(instances)
+
+        for (group, created), count in zip(groups, counts):
+            self._maybe_trim(group, count)
+
+        for (key, value), label in filter_values.iteritems():
+            self._record_filter_value(key, value, label)
+
+        return groups, instances
+
+    def _maybe_trim(self, group, count=1):
+        """
+        Trims the stored messages of ``group`` each time its occurrences
+        pass a multiple of ``SENTRY_TRIM_INTERVAL``.
+        """
+        if not conf.KEEP_LAST_MESSAGES:
+            return
+        if group.times_seen // conf.TRIM_INTERVAL == (group.times_seen - count) // conf.TRIM_INTERVAL:
+            return
+        group.trim_messages(limit=conf.TRIM_BATCH_SIZE)
+
+    def bulk_insert(self, objs):
+        """
+        Inserts a list of new rows with as few statements as possible. Rows
+        are either unsaved instances, or dictionaries of field values in
+        which ``data`` may already be encoded, in which case it is stored
+        as-is.
+
+        PostgreSQL loads the rows with ``COPY FROM STDIN``, other databases
+        use multi-row ``INSERT`` statements. Signals are not sent and the
+        primary keys of the new rows are not fetched.
+        """
+        if not objs:
+            return
+
+        connection = self._get_connection()
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        fields = [f for f in opts.local_fields if not isinstance(f, models.AutoField)]
+        data_field = opts.get_field('data')
+
+        rows = []
+        for obj in objs:
+            encoded = None
+            if isinstance(obj, dict):
+                obj = dict(obj)
+                if isinstance(obj.get('data'), basestring):
+                    encoded = obj.pop('data')
+                obj = self.model(**obj)
+            if not obj.checksum:
+                obj.checksum = construct_checksum(**obj.__dict__)
+            row = []
+            for f in fields:
+                if f is data_field and encoded is not None:
+                    row.append(encoded)
+                else:
+                    row.append(f.get_db_prep_save(f.pre_save(obj, True), connection=connection))
+            rows.append(row)
+
+        cursor = connection.cursor()
+        if get_db_engine(connection.alias).startswith('postgresql'):
+            # Unwrap Django's cursor wrappers to get to psycopg2's copy_from
+            while hasattr(cursor, 'cursor'):
+                cursor = cursor.cursor
+            buf = StringIO()
+            for row in rows:
+                buf.write('\t'.join([_copy_escape(v) for v in row]) + '\n')
+            buf.seek(0)
+            cursor.copy_from(buf, opts.db_table, columns=[f.column for f in fields])
+        else:
+            # SQLite limits a statement to 999 parameters
+            chunk_size = max(1, 999 // len(fields))
+            for i in xrange(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+                cursor.execute('INSERT INTO %s (%s) VALUES %s' % (
+                    qn(opts.db_table),
+                    ', '.join([qn(f.column) for f in fields]),
+                    ', '.join([placeholders] * len(chunk)),
+                ), [v for row in chunk for v in row])
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def _should_store(self, times_seen, event, kwargs):
+        """
+        Returns ``True`` if the occurrence number ``times_seen`` of a group
+        should be stored as a ``Message``, according to the sampling policy.
+        """
+        threshold = conf.SAMPLE_THRESHOLD
+        if conf.SAMPLE_THRESHOLDS:
+            logger_name = event['logger'] or 'root'
+            while logger_name and logger_name not in conf.SAMPLE_THRESHOLDS:
+                logger_name = logger_name.rpartition('.')[0]
+            if logger_name:
+                threshold = conf.SAMPLE_THRESHOLDS[logger_name]
+            else:
+                threshold = conf.SAMPLE_THRESHOLDS.get(kwargs.get('level', logging.ERROR), threshold)
+        return times_seen % get_sample_rate(times_seen, threshold) == 0
+
+    def _pop_event_kwargs(self, kwargs):
+        """
+        Removes the attributes which are not stored as-is on the ``Message``
+        from ``kwargs`` and returns them, along with the checksum of the event.
+        """
+        from sentry.models import Message
+        URL_MAX_LENGTH = Message._meta.get_field_by_name('url')[0].max_length
+
+        event = {
+            'name': kwargs.pop('name', None),
+            'message_type': kwargs.pop("message_type", conf.LOG),
+            'project': kwargs.pop("project"),
+            'site': kwargs.pop('site', None),
+            'test_result': kwargs.pop('test_result', None),
+            # Log specific
+            'logger': kwargs.pop('logger', ''),
+        }
+
+        url = kwargs.pop('url', None)
+        data = kwargs.pop('data', {}) or {}
+        if url:
+            data['url'] = url
+            url = url[:URL_MAX_LENGTH]
+        event['url'] = url
+        event['data'] = data
+
+        # Set by clients which collapse repeats of an event into one
+        event['count'] = kwargs.pop('count', None) or 1
+        first_seen = kwargs.pop('first_seen', None)
+        event['last_seen'] = kwargs.pop('last_seen', None)
+        if event['count'] > 1:
+            data['aggregate'] = {
+                'count': event['count'],
+                'first_seen': first_seen and first_seen.isoformat(),
+                'last_seen': event['last_seen'] and event['last_seen'].isoformat(),
+            }
+
+        event['checksum'] = construct_checksum(**kwargs)
+        return event
+
+    def _get_group_defaults(self, event, kwargs):
+        defaults = dict(kwargs)
+        if 'url' in event['data']:
+            defaults['data'] = {'url': event['data']['url']}
+        return defaults
+
+    def _get_message_kwargs(self, event, kwargs):
+        params = dict(kwargs)
+        params.update(
+            name=event['name'],
+            message_type=event['message_type'],
+            project=event['project'],
+            checksum=event['checksum'],
+
+            logger=event['logger'],
+            data=event['data'],
+            url=event['url'],
+            site=event['site'],
+            test_result=event['test_result'],
+        )
+        if event['last_seen']:
+            params['datetime'] = event['last_seen']
+        return params
+
+    def _get_filter_values(self, event):
+        """
+        Returns the (key, value, label) triples which should be available as
+        ``FilterValue`` choices for this event.
+        """
+        site, project = event['site'], event['project']
+        logger_name, test_result = event['logger'], event['test_result']
+
+        values = []
+        if site:
+            values.append(('site__servername', site.servername, site.servername))
+#        if site:
+#            values.append(('site', site.id, site.name))
+        if site:
+            values.append(('project', project.id, project.name))
+        if logger_name:
+            values.append(('logger', logger_name, logger_name))
+        if test_result:
+            values.append(('test_result', test_result, test_result))
+        return values
+
+    def _record_filter_value(self, key, value, label):
+        from sentry.caches import filter_values
+        from sentry.models import FilterValue
+
+        if conf.FILTER_VALUE_CACHE_SIZE:
+            if filter_values.get((key, value)):
+                return
+        FilterValue.objects.get_or_create(key=key, value=value, label=label)
+        if conf.FILTER_VALUE_CACHE_SIZE:
+            filter_values.set((key, value), True)
+
+    def _record_group(self, event, defaults, count=1, last_seen=None, to_cache=None):
+        """
+        Returns ``(group, created)`` for an event, having added ``count``
+        occurrences to the counters of the group.
+
+        When ``to_cache`` is a list the group is appended to it, for the
+        caller to cache once its transaction was committed, instead of being
+        cached right away.
+        """
+        from sentry.caches import groups, get_group_key
+        from sentry.models import GroupedMessage
+
+        message_type, name, checksum = event['message_type'], event['name'], event['checksum']
+        project, test_result = event['project'], event['test_result']
+        cache_key = get_group_key(message_type, name, checksum, project, test_result)
+
+        use_cache = self._use_group_cache()
+        if use_cache:
+            cached = groups.get(cache_key)
+            if cached:
+                # Known group, skip straight to the counters
+                pk, times_seen = cached
+                group = GroupedMessage(pk=pk, times_seen=times_seen, name=name, message_type=message_type,
+                                       checksum=checksum, project=project, test_result=test_result, **defaults)
+                if self._update_counters(group, count, last_seen):
+                    return group, False
+                # Removed, or rolled back, since it was cached
+                groups.delete(cache_key)
+
+        # Test results are not part of the unique constraint, so they can
+        # not be upserted
+        if message_type != conf.TEST and self._can_upsert():
+            group, created = self._upsert_group_message(message_type, name, checksum, project,
+                                                        defaults, count, last_seen)
+        else:
+            group, created = self._get_or_create_group_message(message_type, name, checksum, project,
+                                                               test_result, defaults)
+            if created:
+                # The first occurrence is accounted for by the insert
+                count -= 1
+            if count:
+                self._update_counters(group, count, last_seen)
+
+        if use_cache:
+            if to_cache is None:
+                groups.set(cache_key, (group.pk, group.times_seen))
+            else:
+                to_cache.append((cache_key, (group.pk, group.times_seen)))
+        return group, created
+
+    def _use_group_cache(self):
+        """
+        Buffered counters never touch the row of a cached group, so a group
+        removed since it was cached would go unnoticed. With a buffer, only
+        entries which ``cleanup_sentry`` clears in every process are used.
+        """
+        from sentry.buffer import get_buffer
+        from sentry.caches import groups
+
+        if not conf.GROUP_CACHE_SIZE:
+            return False
+        return groups.shared or get_buffer() is None
+
     def _get_or_create_group_message(self, message_type, name, 
                                      checksum, project, test_result, kwargs):
         """
@@ -111,23 +409,178 @@ class SentryManager(models.Manager):
             params['test_result'] = test_result
         return GroupedMessage.objects.get_or_create(defaults=kwargs, **params)
 
+    def _can_upsert(self):
+        """
+        Returns ``True`` if the database can create or update a group in a
+        single ``INSERT ... ON CONFLICT DO UPDATE`` statement.
+        """
+        if django.VERSION < (1, 2):
+            return False
+        engine = get_db_engine(conf.DATABASE_USING or 'default')
+        if engine.startswith('postgresql'):
+            connection = self._get_connection()
+            if connection.connection is None:
+                connection.cursor()
+            return connection.connection.server_version >= 90500
+        if engine == 'sqlite3':
+            from django.db.backends.sqlite3.base import Database
+            # RETURNING is only available as of SQLite 3.35
+            return Database.sqlite_version_info >= (3, 35, 0)
+        return False
 
-    def _update_counters(self, group):
+    def _upsert_group_message(self, message_type, name, checksum, project, kwargs, count=1, last_seen=None):
+        """
+        Creates the group, or adds ``count`` occurrences to an existing one,
+        using a single statement. With ``SENTRY_BUFFER`` an existing group is
+        left as it is, and the occurrences go through the buffer.
+        """
+        from sentry.buffer import get_buffer
         from sentry.models import GroupedMessage
-        now = datetime.datetime.now()
-        GroupedMessage.objects.filter(pk=group.pk).update(
-            times_seen=models.F('times_seen') + 1,
-            status=0,
-            last_seen=now,
+
+        connection = self._get_connection()
+        qn = connection.ops.quote_name
+        now = last_seen or datetime.datetime.now()
+        group = GroupedMessage(name=name, message_type=message_type, checksum=checksum, project=project,
+                               times_seen=count, last_seen=now, first_seen=now, **kwargs)
+
+        fields = [f for f in GroupedMessage._meta.local_fields if not isinstance(f, models.AutoField)]
+        table = qn(GroupedMessage._meta.db_table)
+        if get_buffer() is None:
+            action = "DO UPDATE SET "\
+                     "%(times_seen)s = %(table)s.%(times_seen)s + EXCLUDED.%(times_seen)s, "\
+                     "%(last_seen)s = EXCLUDED.%(last_seen)s, %(status)s = 0"
+        else:
+            action = "DO NOTHING"
+        sql = ("INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s) "\
+               "ON CONFLICT (%(unique)s) " + action + " "\
+               "RETURNING %(pk)s, %(times_seen)s") % dict(
+            table=table,
+            columns=', '.join([qn(f.column) for f in fields]),
+            values=', '.join(['%s'] * len(fields)),
+            unique=', '.join([qn(GroupedMessage._meta.get_field(f).column) for f in
+                              ('message_type', 'name', 'checksum', 'project')]),
+            times_seen=qn('times_seen'),
+            last_seen=qn('last_seen'),
+            status=qn('status'),
+            pk=qn(GroupedMessage._meta.pk.column),
         )
+        params = [f.get_db_prep_save(f.pre_save(group, True), connection=connection) for f in fields]
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        transaction.commit_unless_managed(using=connection.alias)
+
+        if row is None:
+            # DO NOTHING returns no row for an existing group
+            group = GroupedMessage.objects.get(name=name, message_type=message_type, checksum=checksum,
+                                               project=project)
+            self._update_counters(group, count, last_seen)
+            return group, False
+
+        group.pk, group.times_seen = row
+
+        # A freshly inserted row is the only way to end up with exactly the
+        # occurrences we just added
+        created = group.times_seen == count
+        signals.post_save.send(sender=GroupedMessage, instance=group, created=created)
+        return group, created
+
+    def _get_connection(self):
+        from django.db import connections
+
+        return connections[conf.DATABASE_USING or 'default']
+
+    def _update_counters(self, group, count=1, last_seen=None):
+        """
+        Adds ``count`` occurrences to ``group``, and sets its ``times_seen``
+        to the total including them (and, with ``SENTRY_BUFFER``, the ones
+        still pending), which sampling and trimming are based on. Returns
+        ``False`` if the group turned out not to exist.
+        """
+        from sentry.buffer import get_buffer
+        from sentry.caches import groups, get_group_key
+        from sentry.models import GroupedMessage
+        now = last_seen or datetime.datetime.now()
+        buffer_ = get_buffer()
+        if buffer_ is not None:
+            # The checksum guards against the pk of a removed group having
+            # been reused
+            stored = list(GroupedMessage.objects.filter(pk=group.pk, checksum=group.checksum)
+                                                .values_list('times_seen', flat=True))
+            if not stored:
+                return False
+            buffer_.incr(group.pk, count, now)
+            times_seen = stored[0] + buffer_.get_pending(group.pk)[0]
+        else:
+            times_seen = self._increment_group(group, count, now)
+            if times_seen is None:
+                return False
         # HACK: maintain appeared state
         if group.status == 1:
             mail = True
         group.status = 0
         group.last_seen = now
-        group.times_seen += 1
+        group.times_seen = times_seen
+        if conf.GROUP_CACHE_SIZE:
+            # Keep the local count roughly in sync, the shared tier is only
+            # refreshed on misses
+            groups.update(get_group_key(group.message_type, group.name, group.checksum,
+                                        group.project_id, group.test_result),
+                          (group.pk, group.times_seen))
         signals.post_save.send(sender=GroupedMessage, instance=group, created=False)
+        return True
+
+    def _increment_group(self, group, count, last_seen):
+        """
+        Adds ``count`` occurrences to the row of ``group``, returning its new
+        ``times_seen``, or ``None`` if there is no such row.
+        """
+        from sentry.models import GroupedMessage
+
+        if self._can_upsert():
+            # Same databases which support RETURNING
+            connection = self._get_connection()
+            qn = connection.ops.quote_name
+            opts = GroupedMessage._meta
+            sql = "UPDATE %(table)s SET %(times_seen)s = %(times_seen)s + %%s, %(status)s = 0, "\
+                  "%(last_seen)s = %%s WHERE %(pk)s = %%s AND %(checksum)s = %%s "\
+                  "RETURNING %(times_seen)s" % dict(
+                table=qn(opts.db_table),
+                times_seen=qn('times_seen'),
+                status=qn('status'),
+                last_seen=qn('last_seen'),
+                pk=qn(opts.pk.column),
+                checksum=qn('checksum'),
+            )
+            last_seen = opts.get_field('last_seen').get_db_prep_save(last_seen, connection=connection)
+            cursor = connection.cursor()
+            cursor.execute(sql, [count, last_seen, group.pk, group.checksum])
+            row = cursor.fetchone()
+            transaction.commit_unless_managed(using=connection.alias)
+            return row and row[0]
+
+        # The checksum guards against the pk of a removed group having been
+        # reused
+        qs = GroupedMessage.objects.filter(pk=group.pk, checksum=group.checksum)
+        if not qs.update(times_seen=models.F('times_seen') + count, status=0, last_seen=last_seen):
+            return None
+        return qs.values_list('times_seen', flat=True)[0]
 
+def _copy_escape(value):
+    """
+    Formats a value for PostgreSQL's ``COPY`` text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return value and 't' or 'f'
+    if not isinstance(value, basestring):
+        value = str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t')\
+                .replace('\n', '\\n').replace('\r', '\\r')
 
 class GroupedMessageManager(SentryManager):
     def get_by_natural_key(self, logger, view, checksum):
@@ -12,11 +12,12 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models, transaction
 from django.db.models import Count
-from django.db.models.signals import post_syncdb
+from django.db.models.signals import post_delete, post_syncdb
 from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext_lazy as _
 
 from sentry import conf
+from sentry.caches import invalidate_filter_value, invalidate_group
 from sentry.helpers import cached_property, construct_checksum, get_db_engine, transform, get_filters
 from sentry.manager import GroupedMessageManager, SentryManager
 from sentry.reporter import FakeRequest
@@ -62,6 +63,8 @@ class GzippedDictField(models.TextField):
 
     def get_prep_value(self, value):
         if value is None: return
+        # Only walks data which didn't come through a client (or the JSON
+        # wire format), as the rest is a NormalizedDict
         return base64.b64encode(pickle.dumps(transform(value)).encode('zlib'))
  
     def value_to_string(self, obj):
@@ -215,7 +218,67 @@ class GroupedMessage(MessageBase):
         send_mail(subject, body,
                   settings.SERVER_EMAIL, conf.ADMINS,
                   fail_silently=fail_silently)
+
+    @classmethod
+    def mail_admins_digest(cls, groups, request=None, fail_silently=True):
+        """
+        Sends a single mail listing several new messages.
+        """
+        if not conf.ADMINS:
+            return
+
+        from django.core.mail import send_mail
+        from django.template.loader import render_to_string
+
+        group_list = []
+        for group in groups:
+            if request:
+                link = request.build_absolute_url(group.get_absolute_url())
+            else:
+                link = '%s%s' % (conf.URL_PREFIX, group.get_absolute_url())
+            group_list.append((group, link))
+
+        subject = '%d new errors' % (len(group_list),)
+        body = render_to_string('sentry/emails/digest.txt', {
+            'group_list': group_list,
+        })
+
+        send_mail(subject, body,
+                  settings.SERVER_EMAIL, conf.ADMINS,
+                  fail_silently=fail_silently)
     
+    def trim_messages(self, keep_first=None, keep_last=None, limit=None):
+        """
+        Removes the stored messages of this group, except for the first
+        ``keep_first`` and the most recent ``keep_last`` ones. At most
+        ``limit`` messages are removed. Returns the number removed.
+        """
+        if keep_first is None:
+            keep_first = conf.KEEP_FIRST_MESSAGES
+        if keep_last is None:
+            keep_last = conf.KEEP_LAST_MESSAGES
+        if not keep_last:
+            return 0
+
+        message_ids = self.message_set.values_list('id', flat=True)
+        upper = list(message_ids.order_by('-id')[keep_last:keep_last + 1])
+        if not upper:
+            return 0
+        doomed = message_ids.filter(id__lte=upper[0])
+        if keep_first:
+            lower = list(message_ids.order_by('id')[keep_first - 1:keep_first])
+            if not lower:
+                return 0
+            doomed = doomed.filter(id__gt=lower[0])
+
+        doomed = doomed.order_by('id')
+        if limit:
+            doomed = doomed[:limit]
+        doomed = list(doomed)
+        if doomed:
+            Message.objects.filter(id__in=doomed).delete()
+        return len(doomed)
+
     @property
     def unique_urls(self):
         return self.message_set.filter(url__isnull=False)\
@@ -325,6 +388,9 @@ register_indexes()
 # post_syncdb.connect(GroupedMessage.create_sort_index, sender=__name__)
 post_syncdb.connect(GroupedMessage.create_sort_index, sender=sys.modules[__name__])
 
+post_delete.connect(invalidate_filter_value, sender=FilterValue)
+post_delete.connect(invalidate_group, sender=GroupedMessage)
+
 #import logging
 #from sentry.client.handlers import SentryHandler
 #logging.getLogger().addHandler(SentryHandler())
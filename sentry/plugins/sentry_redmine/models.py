@@ -7,13 +7,12 @@ from django.shortcuts import render_to_response
 from django.utils import simplejson
 from django.utils.safestring import mark_safe
 
-from sentry.helpers import urlread
+from sentry.http import urlread
 from sentry.models import GroupedMessage
 from sentry.plugins import GroupActionProvider
 from sentry.plugins.sentry_redmine import conf
 
 import base64
-import urllib
 import urllib2
 
 class RedmineIssue(models.Model):
@@ -45,18 +44,18 @@ class CreateRedmineIssue(GroupActionProvider):
                 })
                 url = conf.REDMINE_URL + '/projects/' + conf.REDMINE_PROJECT_SLUG + '/issues.json'
                 
-                req = urllib2.Request(url, urllib.urlencode({
-                    'key': conf.REDMINE_API_KEY,
-                }), headers={
-                    'Content-type': 'application/json',
-                })
+                headers = {
+                    'Content-Type': 'application/json',
+                }
 
                 if conf.REDMINE_USERNAME and conf.REDMINE_PASSWORD:
                     authstring = base64.encodestring('%s:%s' % (conf.REDMINE_USERNAME, conf.REDMINE_PASSWORD))[:-1]
-                    req.add_header("Authorization", "Basic %s" % authstring)
+                    headers['Authorization'] = "Basic %s" % authstring
                 
                 try:
-                    response = urllib2.urlopen(req, data).read()
+                    response = urlread(url, get={
+                        'key': conf.REDMINE_API_KEY,
+                    }, headers=headers, data=data)
                 except urllib2.HTTPError, e:
                     if e.code == 422:
                         data = simplejson.loads(e.read())
@@ -4,6 +4,7 @@ from django.utils import simplejson
 from django.template.loader import render_to_string
 
 from sentry import conf
+from sentry.buffer import get_buffer
 from sentry.helpers import get_db_engine
 from sentry.plugins import GroupActionProvider
 
@@ -39,6 +40,13 @@ def with_priority(result_list, key='score'):
                 priority = 'verylow'
             yield result, priority
 
+@register.filter
+def with_pending_counts(result_list):
+    buffer_ = get_buffer()
+    if buffer_ is None:
+        return result_list
+    return buffer_.apply(result_list)
+
 @register.filter
 def num_digits(value):
     return len(str(value))
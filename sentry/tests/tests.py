@@ -8,6 +8,7 @@ except ImportError:
 import getpass
 import logging
 import os.path
+import Queue
 import sys
 import threading
 
@@ -90,7 +91,72 @@ def conditional_on_module(module):
         return inner
     return wrapped
 
-class SentryTestCase(TestCase):
+def reset_state():
+    """
+    Drops whatever was left pending in the module level buffers and queues, and
+    the singletons which were built from the settings of the previous test.
+    """
+    from sentry import buffer, caches, http
+    from sentry.client import aggregator, base, models as client_models, spool
+
+    caches.clear_caches()
+
+    if buffer._buffer[1] is not None:
+        list(buffer._buffer[1]._pop_pending())
+    buffer._buffer = (None, None)
+
+    if aggregator._aggregator[1] is not None:
+        aggregator._aggregator[1]._open = {}
+    aggregator._aggregator = (None, None)
+
+    if base._exception_pool is not None:
+        base._exception_pool.join()
+    base._exception_pool = None
+
+    # The mail and celery queues are only there if their modules were loaded
+    mail_module = sys.modules.get('sentry.mail')
+    celery_module = sys.modules.get('sentry.client.celery.client')
+    for module, name in ((base, '_remote_queue'), (mail_module, '_mail_queue'),
+                         (celery_module, '_celery_queue')):
+        worker = getattr(module, name, None)
+        if worker is None:
+            continue
+        while True:
+            try:
+                worker.queue.get_nowait()
+            except Queue.Empty:
+                break
+            worker.queue.task_done()
+        setattr(module, name, None)
+
+    base._resolver = (None, None)
+    base._legacy_urls.clear()
+    base._limiter = (None, None)
+    base._breaker = None
+    http._pool = None
+    http._thread_pool = None
+    spool._spool = None
+    client_models._client = (None, None)
+
+class BaseTestCase(TestCase):
+    """
+    Restores the settings of ``sentry.conf`` after each test, and starts each
+    one from the state a new process would have, as rolling back the test's
+    transaction doesn't reset the caches and singletons kept in memory.
+    """
+    def _pre_setup(self):
+        self._conf = dict((k, v) for k, v in vars(conf).iteritems() if k.isupper())
+        reset_state()
+        super(BaseTestCase, self)._pre_setup()
+
+    def _post_teardown(self):
+        super(BaseTestCase, self)._post_teardown()
+        for k in [k for k in vars(conf) if k.isupper() and k not in self._conf]:
+            delattr(conf, k)
+        for k, v in self._conf.iteritems():
+            setattr(conf, k, v)
+
+class SentryTestCase(BaseTestCase):
     urls = 'sentry.tests.urls'
 
     def setUp(self):
@@ -572,8 +638,253 @@ class SentryTestCase(TestCase):
         message = client.create_from_record(record)
         self.assertEquals('test', message.message)
 
+    def testFromKwargsBatch(self):
+        events = [dict(message='foo', level=logging.ERROR) for i in range(0, 3)]
+        events.append(dict(message='bar', level=logging.WARNING))
+
+        instances = GroupedMessage.objects.from_kwargs_batch(events)
+
+        self.assertEquals(len(instances), 4)
+        self.assertEquals(Message.objects.count(), 4)
+        self.assertEquals(GroupedMessage.objects.count(), 2)
+        group = GroupedMessage.objects.get(message='foo')
+        self.assertEquals(group.times_seen, 3)
+        self.assertEquals(group.message_set.count(), 3)
+        group = GroupedMessage.objects.get(message='bar')
+        self.assertEquals(group.times_seen, 1)
+
+        GroupedMessage.objects.from_kwargs_batch(events[:2])
+
+        self.assertEquals(GroupedMessage.objects.get(message='foo').times_seen, 5)
+
+    def testBufferedCounters(self):
+        from sentry.buffer import get_buffer
+
+        conf.BUFFER = 'memory'
+
+        for i in range(0, 5):
+            get_client().create_from_text('hi')
+
+        group = GroupedMessage.objects.get()
+        self.assertEquals(group.times_seen, 1)
+        self.assertEquals(Message.objects.count(), 5)
+
+        buffer_ = get_buffer()
+        self.assertEquals(buffer_.get_pending(group.pk)[0], 4)
+        self.assertEquals(buffer_.apply([group])[0].times_seen, 5)
+
+        buffer_.flush()
+
+        self.assertEquals(buffer_.get_pending(group.pk)[0], 0)
+        self.assertEquals(GroupedMessage.objects.get().times_seen, 5)
+
+        conf.BUFFER = None
+
+    def testFilterValueCache(self):
+        from sentry.caches import filter_values
+        from sentry.models import FilterValue
+
+        filter_values.clear()
+
+        for i in range(0, 3):
+            get_client().create_from_text('hi', logger='foo')
+
+        self.assertEquals(FilterValue.objects.filter(key='logger', value='foo').count(), 1)
+        stats = filter_values.get_stats()
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['misses'], 1)
+
+        FilterValue.objects.all().delete()
+        self.assertFalse(('logger', 'foo') in filter_values.local)
+
+        get_client().create_from_text('hi', logger='foo')
+
+        self.assertEquals(FilterValue.objects.filter(key='logger', value='foo').count(), 1)
+
+    def testGroupCache(self):
+        from sentry.caches import groups
+
+        groups.clear()
+
+        for i in range(0, 3):
+            get_client().create_from_text('hi')
+
+        self.assertEquals(groups.get_stats()['hits'], 2)
+        group = GroupedMessage.objects.get()
+        self.assertEquals(group.times_seen, 3)
+        self.assertEquals(group.message_set.count(), 3)
+
+        GroupedMessage.objects.all().delete()
+
+        get_client().create_from_text('hi')
+
+        self.assertEquals(GroupedMessage.objects.get().times_seen, 1)
+
+        # Removed behind the cache's back, e.g. by a rolled back transaction
+        from django.db import connection
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM sentry_message')
+        cursor.execute('DELETE FROM sentry_groupedmessage')
+
+        get_client().create_from_text('hi')
+
+        group = GroupedMessage.objects.get()
+        self.assertEquals(group.times_seen, 1)
+        self.assertEquals(Message.objects.get().group, group)
+
+        # Buffered counters don't notice a removed group, so the local cache
+        # is not used along with them
+        from sentry.buffer import get_buffer
+        conf.BUFFER = 'memory'
+        try:
+            cursor.execute('DELETE FROM sentry_message')
+            cursor.execute('DELETE FROM sentry_groupedmessage')
+
+            get_client().create_from_text('hi')
+
+            group = GroupedMessage.objects.get()
+            self.assertEquals(Message.objects.get().group, group)
+            get_buffer().flush()
+        finally:
+            conf.BUFFER = None
+
+    def testUpsertGroupMessage(self):
+        if not GroupedMessage.objects._can_upsert():
+            print "Skipping test: %s.testUpsertGroupMessage" % (self.__class__.__name__,)
+            return
+
+        prev = conf.GROUP_CACHE_SIZE
+        conf.GROUP_CACHE_SIZE = 0
+
+        for i in range(0, 3):
+            get_client().create_from_text('hi')
+
+        group = GroupedMessage.objects.get()
+        self.assertEquals(group.times_seen, 3)
+        self.assertEquals(group.message_set.count(), 3)
+
+        # Counters of existing groups go through the buffer
+        from sentry.buffer import get_buffer
+        conf.BUFFER = 'memory'
+
+        for i in range(0, 2):
+            get_client().create_from_text('hi')
+
+        self.assertEquals(GroupedMessage.objects.get().times_seen, 3)
+        self.assertEquals(get_buffer().get_pending(group.pk)[0], 2)
+        get_buffer().flush()
+        self.assertEquals(GroupedMessage.objects.get().times_seen, 5)
+
+        conf.BUFFER = None
+        conf.GROUP_CACHE_SIZE = prev
+
+    def testSampling(self):
+        conf.SAMPLE_THRESHOLD = 10
+
+        for i in range(0, 50):
+            get_client().create_from_text('hi')
+
+        group = GroupedMessage.objects.get()
+        self.assertEquals(group.times_seen, 50)
+        # Every event up to the threshold, then one in ten
+        self.assertEquals(group.message_set.count(), 14)
+
+        conf.SAMPLE_THRESHOLDS = {'foo': 0}
+
+        for i in range(0, 50):
+            get_client().create_from_text('hi', logger='foo.bar')
+
+        group = GroupedMessage.objects.get(logger='foo.bar')
+        self.assertEquals(group.message_set.count(), 50)
+
+        conf.SAMPLE_THRESHOLD = 0
+        conf.SAMPLE_THRESHOLDS = {}
+
+    def testTrimMessages(self):
+        conf.KEEP_FIRST_MESSAGES = 2
+        conf.KEEP_LAST_MESSAGES = 3
+        conf.TRIM_INTERVAL = 5
+
+        for i in range(0, 10):
+            get_client().create_from_text('hi')
+
+        group = GroupedMessage.objects.get()
+        self.assertEquals(group.times_seen, 10)
+        message_ids = list(group.message_set.order_by('id').values_list('id', flat=True))
+        self.assertEquals(len(message_ids), 5)
+        self.assertEquals(message_ids[2] - message_ids[1], 6)
+
+        conf.KEEP_FIRST_MESSAGES = 10
+        conf.KEEP_LAST_MESSAGES = 0
+        conf.TRIM_INTERVAL = 100
+
+    def testBufferedSampling(self):
+        from sentry.buffer import get_buffer
+        conf.BUFFER = 'memory'
+        conf.SAMPLE_THRESHOLD = 10
+        conf.KEEP_FIRST_MESSAGES = 2
+        conf.KEEP_LAST_MESSAGES = 10
+        conf.TRIM_INTERVAL = 25
+        try:
+            for i in range(0, 50):
+                get_client().create_from_text('hi')
+
+            # Decisions are based on the count including pending occurrences
+            group = GroupedMessage.objects.get()
+            self.assertEquals(group.times_seen, 1)
+            # 14 sampled, then trimmed to the first 2 and last 10 at the 50th
+            self.assertEquals(group.message_set.count(), 12)
+
+            get_buffer().flush()
+            self.assertEquals(GroupedMessage.objects.get().times_seen, 50)
+        finally:
+            conf.BUFFER = None
+            conf.SAMPLE_THRESHOLD = 0
+            conf.KEEP_FIRST_MESSAGES = 10
+            conf.KEEP_LAST_MESSAGES = 0
+            conf.TRIM_INTERVAL = 100
+
+    def testCaptureBudget(self):
+        conf.MAX_FRAMES = 4
+        conf.MAX_VARIABLES = 2
+
+        def recurse(depth, value):
+            if not depth:
+                raise ValueError('deep')
+            recurse(depth - 1, value)
+        try:
+            recurse(10, range(0, 10))
+        except ValueError:
+            get_client().create_from_exception()
+
+        frames = Message.objects.get().data['__sentry__']['exc'][2]
+        # The two outermost and innermost frames, and the omitted ones between
+        self.assertEquals(len(frames), 5)
+        self.assertEquals(frames[2]['function'], '(8 frames omitted)')
+        self.assertEquals(frames[-1]['function'], 'recurse')
+        self.assertEquals(len(frames[-1]['vars']), 2)
+
+        conf.MAX_FRAMES = 50
+        conf.MAX_VARIABLES = 100
+
+    def testBulkInsert(self):
+        get_client().create_from_text('hi')
+        message = Message.objects.get()
+        encoded = Message._meta.get_field('data').get_prep_value({'foo': 'baz'})
+
+        Message.objects.bulk_insert([
+            Message(group=message.group, message='hi', checksum=message.checksum, data={'foo': 'bar'}),
+            {'group': message.group, 'message': 'hi', 'checksum': message.checksum, 'data': encoded},
+        ])
+
+        self.assertEquals(Message.objects.count(), 3)
+        messages = Message.objects.order_by('id')
+        self.assertEquals(messages[1].data, {'foo': 'bar'})
+        self.assertEquals(messages[2].data, {'foo': 'baz'})
+        self.assertEquals(messages[2].group, message.group)
+
 
-class SentryViewsTest(TestCase):
+class SentryViewsTest(BaseTestCase):
     urls = 'sentry.tests.urls'
     fixtures = ['sentry/tests/fixtures/views.json']
     
@@ -637,7 +948,7 @@ class SentryViewsTest(TestCase):
         self.assertEquals(resp.status_code, 200)
         self.assertTemplateUsed(resp, 'sentry/group/details.html')
 
-class RemoteSentryTest(TestCase):
+class RemoteSentryTest(BaseTestCase):
     urls = 'sentry.tests.urls'
     
     def start_test_server(self, address='localhost', port=8000):
@@ -710,6 +1021,78 @@ class RemoteSentryTest(TestCase):
         self.assertEquals(instance.site, 'not_a_real_site')
         self.assertEquals(instance.level, 40)
 
+    def testBatchData(self):
+        events = [
+            {'message': 'hello', 'server_name': 'not_dcramer.local', 'level': 40},
+            {'message': 'hello', 'server_name': 'not_dcramer.local', 'level': 40},
+            {'message': 'world', 'server_name': 'not_dcramer.local', 'level': 40},
+        ]
+        resp = self.client.post(reverse('sentry-store'), {
+            'data': base64.b64encode(pickle.dumps(transform(events)).encode('zlib')),
+            'key': conf.KEY,
+        })
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(Message.objects.count(), 3)
+        self.assertEquals(GroupedMessage.objects.count(), 2)
+        self.assertEquals(GroupedMessage.objects.get(message='hello').times_seen, 2)
+
+    def testVersion2Data(self):
+        from sentry import wire
+        kwargs = {'message': 'hello', 'server_name': 'not_dcramer.local', 'level': 40, 'site': 'not_a_real_site'}
+        resp = self.client.post(reverse('sentry-store'), wire.encode(kwargs),
+                                content_type='application/octet-stream',
+                                HTTP_X_SENTRY_VERSION='2', HTTP_X_SENTRY_KEY=conf.KEY)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp['X-Sentry-Version'], '2')
+        instance = Message.objects.get()
+        self.assertEquals(instance.message, 'hello')
+        self.assertEquals(instance.server_name, 'not_dcramer.local')
+        self.assertEquals(instance.level, 40)
+
+        resp = self.client.post(reverse('sentry-store'), wire.encode(kwargs),
+                                content_type='application/octet-stream',
+                                HTTP_X_SENTRY_VERSION='2', HTTP_X_SENTRY_KEY='foo')
+        self.assertEquals(resp.status_code, 403)
+
+    def testVersion2Project(self):
+        from sentry import wire
+        project = GroupedMessage._meta.get_field('project').rel.to.objects.create(name='test')
+        events = [
+            {'message': 'hello', 'level': 40, 'project': project},
+            {'message': 'world', 'level': 40, 'project': project},
+        ]
+        data = wire.encode(events)
+        self.assertEquals([e['project'] for e in wire.decode(data)], [project, project])
+        self.assertEquals(set(['project', 'site', 'test']) - set(wire.get_related_fields()), set())
+
+        resp = self.client.post(reverse('sentry-store'), data,
+                                content_type='application/octet-stream',
+                                HTTP_X_SENTRY_VERSION='2', HTTP_X_SENTRY_KEY=conf.KEY)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(Message.objects.filter(project=project).count(), 2)
+        self.assertEquals(GroupedMessage.objects.filter(project=project).count(), 2)
+
+    def testDeflateData(self):
+        import zlib
+        from sentry import wire
+        kwargs = {'message': 'hello', 'server_name': 'not_dcramer.local', 'level': 40}
+        resp = self.client.post(reverse('sentry-store'), zlib.compress(wire.encode(kwargs)),
+                                content_type='application/octet-stream',
+                                HTTP_CONTENT_ENCODING='deflate',
+                                HTTP_X_SENTRY_VERSION='2', HTTP_X_SENTRY_KEY=conf.KEY)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(Message.objects.get().message, 'hello')
+
+        prev = conf.MAX_STORE_SIZE
+        conf.MAX_STORE_SIZE = 1024
+        kwargs['message'] = 'a' * 2048
+        resp = self.client.post(reverse('sentry-store'), zlib.compress(wire.encode(kwargs)),
+                                content_type='application/octet-stream',
+                                HTTP_CONTENT_ENCODING='deflate',
+                                HTTP_X_SENTRY_VERSION='2', HTTP_X_SENTRY_KEY=conf.KEY)
+        self.assertEquals(resp.status_code, 413)
+        conf.MAX_STORE_SIZE = prev
+
     def testByteSequence(self):
         """
         invalid byte sequence for encoding "UTF8": 0xedb7af
@@ -746,7 +1129,7 @@ class RemoteSentryTest(TestCase):
     #     self.assertEquals(instance.url, 'http://testserver/?test')
     #     self.stop_test_server()
 
-class SentryFeedsTest(TestCase):
+class SentryFeedsTest(BaseTestCase):
     fixtures = ['sentry/tests/fixtures/feeds.json']
     urls = 'sentry.tests.urls'
     
@@ -768,7 +1151,7 @@ class SentryFeedsTest(TestCase):
         self.assertTrue('<link>http://testserver/group/1</link>' in response.content, response.content)
         self.assertTrue('<title>(1) TypeError: exceptions must be old-style classes or derived from BaseException, not NoneType</title>' in response.content)
 
-class SentryMailTest(TestCase):
+class SentryMailTest(BaseTestCase):
     fixtures = ['sentry/tests/fixtures/mail.json']
     urls = 'sentry.tests.urls'
     
@@ -836,7 +1219,34 @@ class SentryMailTest(TestCase):
 
         self.assertTrue('http://example.com/group/2' in out.body, out.body)
 
-class SentryHelpersTest(TestCase):
+    def test_mail_digest(self):
+        from sentry.mail import send_queued_mail
+
+        self.assertRaises(Exception, self.client.get, reverse('sentry-raise-exc'))
+        self.assertEquals(GroupedMessage.objects.count(), 2)
+        mail.outbox = []
+
+        send_queued_mail([g.pk for g in GroupedMessage.objects.all()])
+        self.assertEquals(len(mail.outbox), 1)
+
+        out = mail.outbox[0]
+
+        self.assertEquals(out.subject, '2 new errors')
+        self.assertTrue('view exception' in out.body, out.body)
+
+    def test_mail_throttle(self):
+        from sentry.mail import notify_admins
+
+        conf.MAIL_THROTTLE = 60
+
+        group = GroupedMessage.objects.get()
+        notify_admins(group)
+        notify_admins(group)
+        self.assertEquals(len(mail.outbox), 1)
+
+        conf.MAIL_THROTTLE = 0
+
+class SentryHelpersTest(BaseTestCase):
     def test_get_db_engine(self):
         from sentry.helpers import get_db_engine
         _databases = getattr(settings, 'DATABASES', {}).copy()
@@ -858,7 +1268,108 @@ class SentryHelpersTest(TestCase):
         settings.DATABASES = _databases
         settings.DATABASE_ENGINE = _engine
 
-class SentryClientTest(TestCase):
+    def test_prefix_index(self):
+        from sentry.helpers import PrefixIndex
+        index = PrefixIndex(['sentry', 'sentry.client', 'django.contrib.admin'])
+
+        self.assertTrue('sentry.views.index' in index)
+        self.assertTrue('django.contrib.admin.sites' in index)
+        self.assertFalse('django.contrib.auth' in index)
+        self.assertFalse('' in index)
+        self.assertFalse('' in PrefixIndex([]))
+
+    def test_normalizer(self):
+        from sentry.helpers import Normalizer, register_type
+
+        value = {'foo': ['bar', 1, 2.5, None], 'baz': object}
+        value['self'] = value
+        self.assertEquals(transform(value), {
+            'foo': [u'bar', 1, 2.5, None],
+            'baz': u"<type 'object'>",
+            'self': u'<recursion>',
+        })
+
+        normalizer = Normalizer(max_length=3, max_items=2, max_depth=1)
+        self.assertEquals(normalizer.normalize(['abcdef', [1], 'x']), [u'abc...', u'[1]'])
+
+        normalizer = Normalizer(max_size=4)
+        self.assertEquals(normalizer.normalize(['abc', 'def', 'ghi']), [u'abc', u'def'])
+
+        class Point(object):
+            pass
+        register_type(Point, lambda value: 'point')
+        self.assertEquals(transform([Point()]), [u'point'])
+
+    def test_normalized_dict(self):
+        import pickle
+        from sentry.helpers import NormalizedDict
+
+        value = NormalizedDict(foo=['bar'])
+        self.assertTrue(transform({'data': value})['data'] is value)
+        self.assertEquals(type(pickle.loads(pickle.dumps(value))), dict)
+
+        # Data coming through a client or the JSON wire format is only
+        # walked once
+        from sentry import wire
+        self.assertEquals(type(wire.decode(wire.encode({'data': {'foo': 'bar'}}))['data']), NormalizedDict)
+
+        # Data which didn't is normalized when stored
+        field = Message._meta.get_field('data')
+        self.assertEquals(field.to_python(field.get_prep_value({'foo': object})), {'foo': u"<type 'object'>"})
+
+    def test_call_limiter(self):
+        from sentry.helpers import CallLimiter
+        limiter = CallLimiter(limit=3, size=1)
+
+        self.assertEquals([limiter.consume('a') for i in range(0, 4)], [True, True, True, False])
+        self.assertTrue(limiter.consume('b'))
+        # 'a' was pushed out by 'b', so it starts over
+        self.assertTrue(limiter.consume('a'))
+
+    def test_circuit_breaker(self):
+        from sentry.http import CircuitBreaker
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+
+        breaker.failure('a')
+        self.assertTrue(breaker.allow('a'))
+        breaker.failure('a')
+        self.assertFalse(breaker.allow('a'))
+        self.assertTrue(breaker.allow('b'))
+
+        breaker.cooldown = 0
+        breaker.failure('a')
+        self.assertTrue(breaker.allow('a'))
+        breaker.success('a')
+        breaker.cooldown = 60
+        breaker.failure('a')
+        self.assertTrue(breaker.allow('a'))
+
+    def test_urlread_many_deadline(self):
+        from sentry import http
+
+        event = threading.Event()
+        late = []
+        def func(url):
+            event.wait(5)
+
+        http._thread_pool = http.ThreadPool(1)
+        try:
+            breaker = http.CircuitBreaker(threshold=1)
+            results = http.urlread_many(['a', 'b'], deadline=0.1, breaker=breaker, func=func,
+                                        on_late=lambda url, e: late.append((url, e)))
+            self.assertTrue(isinstance(results['a'], http.RemoteTimeout))
+            self.assertTrue(isinstance(results['b'], http.NotSent))
+            # Neither host is to blame yet
+            self.assertTrue(breaker.allow('a'))
+            self.assertTrue(breaker.allow('b'))
+
+            event.set()
+            http._thread_pool.join()
+            self.assertEquals(late, [('a', None)])
+        finally:
+            http._thread_pool = None
+
+class SentryClientTest(BaseTestCase):
     urls = 'sentry.tests.urls'
 
     def setUp(self):
@@ -916,8 +1427,194 @@ class SentryClientTest(TestCase):
         self.assertEqual(message.message, 'view exception')
 
         conf.CLIENT = 'sentry.client.base.SentryClient'
-        
-class SentryManageTest(TestCase):
+
+    def test_queued_handler(self):
+        from sentry.client.handlers import QueuedSentryHandler
+
+        handler = QueuedSentryHandler()
+        logger = logging.getLogger('queued')
+        try:
+            raise ValueError('foo')
+        except ValueError:
+            record = logger.makeRecord('queued', logging.ERROR, __file__, 0, 'bar %s', ('baz',), sys.exc_info())
+        record = handler.prepare(record)
+        self.assertEquals(record.exc_info, None)
+        handler.send_records([record])
+
+        group = GroupedMessage.objects.get()
+        self.assertEquals(group.class_name, 'ValueError')
+        self.assertEquals(group.message, 'bar baz')
+        self.assertEquals(group.logger, 'queued')
+
+    def test_celery_batch(self):
+        from sentry.client.celery import tasks
+
+        events = [dict(message='foo', level=logging.ERROR, server_name='bar') for i in xrange(3)]
+        tasks.send_batch.delay(events)
+
+        self.assertEquals(GroupedMessage.objects.get().times_seen, 3)
+
+    def test_async_client(self):
+        try:
+            import trollius as asyncio
+        except ImportError:
+            print "Skipping test: %s.test_async_client" % (self.__class__.__name__,)
+            return
+        from sentry.client.aio import AsyncSentryClient
+
+        conf.CLIENT = 'sentry.client.aio.AsyncSentryClient'
+        self.assertEquals(get_client().__class__, AsyncSentryClient)
+
+        # Nothing listens there, so the event ends up in the local log
+        conf.REMOTE_URL = ['http://localhost:1/store/']
+        loop = asyncio.new_event_loop()
+        try:
+            client = AsyncSentryClient(loop)
+            future = client.create_from_text('hello')
+            loop.run_until_complete(future)
+            self.assertTrue(future.done())
+        finally:
+            conf.REMOTE_URL = None
+            loop.close()
+
+        conf.CLIENT = 'sentry.client.base.SentryClient'
+
+    def test_legacy_payload(self):
+        import pickle
+        import urllib2
+        from sentry.client import base
+
+        posts = []
+        def urlread(url, post=None, timeout=None):
+            if len(posts) == 1:
+                raise urllib2.URLError('down')
+            posts.append(pickle.loads(base64.b64decode(post['data']).decode('zlib')))
+
+        events = [{'message': 'foo'}, {'message': 'bar'}, {'message': 'baz'}]
+        payload = base.RemotePayload(events)
+        prev, base.urlread = base.urlread, urlread
+        prev_version, conf.WIRE_VERSION = conf.WIRE_VERSION, 1
+        try:
+            # Older servers get one event per request
+            self.assertRaises(urllib2.URLError, base.send_payload, 'http://a/', payload)
+            self.assertEquals(posts, events[:1])
+            self.assertEquals(payload.unsent('http://a/'), events[1:])
+            self.assertEquals(payload.unsent('http://b/'), events)
+        finally:
+            base.urlread = prev
+            conf.WIRE_VERSION = prev_version
+
+    def test_spool(self):
+        import shutil
+        import tempfile
+        from sentry.client.spool import Spool
+
+        path = tempfile.mkdtemp()
+        try:
+            spool = Spool(path, segment_size=1)
+            spool.append('http://a/', {'message': 'foo'})
+            spool.append('http://b/', [{'message': 'bar'}, {'message': 'baz'}])
+            self.assertEquals(len(spool.segments()), 2)
+
+            sent = []
+            def send(url, payload):
+                if url == 'http://b/':
+                    return False
+                sent.append(payload)
+            self.assertEquals(spool.replay(send), 1)
+            self.assertEquals(sent, [{'message': 'foo'}])
+
+            records = []
+            for segment in spool.segments():
+                records.extend(spool.read(segment))
+            self.assertEquals(records, [('http://b/', [{'message': 'bar'}, {'message': 'baz'}])])
+
+            # A segment removed by another process while it is replayed
+            # doesn't stop the remaining ones from being replayed
+            spool.append('http://c/', {'message': 'qux'})
+            def send(url, payload):
+                os.unlink(spool.segments()[0])
+            self.assertEquals(spool.replay(send), 2)
+        finally:
+            shutil.rmtree(path)
+
+    def test_snapshot_traceback(self):
+        import traceback
+        from sentry.client.base import snapshot_traceback
+
+        try:
+            raise ValueError('foo')
+        except ValueError:
+            exc_type, exc_value, tb = sys.exc_info()
+        snapshot = snapshot_traceback(tb)
+        self.assertEquals(traceback.format_exception(exc_type, exc_value, snapshot),
+                          traceback.format_exception(exc_type, exc_value, tb))
+
+        SentryClient()._create_from_exception((exc_type, exc_value, snapshot))
+        message = GroupedMessage.objects.get()
+        self.assertEquals(message.class_name, 'ValueError')
+        self.assertEquals(message.message, 'foo')
+
+    def test_exception_pool(self):
+        from sentry.client import base
+
+        events = []
+        class Client(SentryClient):
+            def send(self, **kwargs):
+                events.append(kwargs)
+                return 'sent'
+
+        conf.EXCEPTION_POOL_SIZE = 1
+        base._exception_pool = None
+        try:
+            value = ['before']
+            try:
+                raise ValueError('foo')
+            except ValueError:
+                self.assertEquals(Client().create_from_exception(), None)
+            # Changed before the event is built
+            value.append('after')
+            base.flush_exception_pool()
+
+            self.assertEquals(len(events), 1)
+            self.assertEquals(events[0]['class_name'], 'ValueError')
+            frame = events[0]['data']['__sentry__']['exc'][2][-1]
+            self.assertTrue([u'value', [u'before']] in frame['vars'])
+
+            # Handled right away while too many exceptions are waiting
+            conf.EXCEPTION_QUEUE_SIZE = 0
+            try:
+                raise ValueError('foo')
+            except ValueError:
+                self.assertEquals(Client().create_from_exception(), 'sent')
+            self.assertEquals(len(events), 2)
+        finally:
+            conf.EXCEPTION_POOL_SIZE = 0
+            conf.EXCEPTION_QUEUE_SIZE = 1000
+            base._exception_pool = None
+
+    def test_aggregation(self):
+        from sentry.client.aggregator import flush_aggregator
+
+        conf.AGGREGATE_INTERVAL = 60
+        try:
+            client = SentryClient()
+            for i in xrange(4):
+                client.create_from_text('hello')
+            self.assertEquals(Message.objects.count(), 1)
+
+            flush_aggregator()
+            self.assertEquals(GroupedMessage.objects.get().times_seen, 4)
+            last = Message.objects.order_by('-id')[0]
+            self.assertEquals(last.data['aggregate']['count'], 3)
+            first_seen = last.data['aggregate']['first_seen']
+            last_seen = last.data['aggregate']['last_seen']
+            self.assertTrue(first_seen <= last_seen)
+            self.assertEquals(last.datetime.strftime('%Y-%m-%dT%H:%M:%S'), last_seen[:19])
+        finally:
+            conf.AGGREGATE_INTERVAL = 0
+
+class SentryManageTest(BaseTestCase):
     fixtures = ['sentry/tests/fixtures/cleanup.json']
     
     def test_cleanup_sentry(self):
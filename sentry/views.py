@@ -6,6 +6,7 @@ except ImportError:
 import datetime
 import logging
 import zlib
+from cStringIO import StringIO
 
 from django.db.models import Q
 from django.core.context_processors import csrf
@@ -19,11 +20,11 @@ from django.utils.safestring import mark_safe
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 
 from annoying.decorators import render_to
-from sentry import conf
+from sentry import conf, wire
 from sentry.helpers import get_filters
 from sentry.models import GroupedMessage, Message
 from sentry.plugins import GroupActionProvider
-from sentry.templatetags.sentry_helpers import with_priority
+from sentry.templatetags.sentry_helpers import with_priority, with_pending_counts
 from sentry.reporter import ImprovedExceptionReporter
 
 def login_required(func):
@@ -151,7 +152,7 @@ def ajax_handler(request):
                 }),
                 'count': m.times_seen,
                 'priority': p,
-            }) for m, p in with_priority(message_list[0:15])]
+            }) for m, p in with_priority(with_pending_counts(message_list[0:15]))]
 
     elif op == 'resolve':
         gid = request.REQUEST.get('gid')
@@ -187,6 +188,7 @@ def ajax_handler(request):
 @render_to('sentry/group/details.html')
 def group(request, group_id):
     group = get_object_or_404(GroupedMessage, pk=group_id)
+    group = with_pending_counts([group])[0]
 
     obj = group.message_set.all().order_by('-id')[0]
     if '__sentry__' in obj.data:
@@ -220,6 +222,7 @@ def group(request, group_id):
 @render_to('sentry/group/message_list.html')
 def group_message_list(request, group_id):
     group = get_object_or_404(GroupedMessage, pk=group_id)
+    group = with_pending_counts([group])[0]
     message_list = group.message_set.all().order_by('-datetime')
     page = 'messages'
     return locals()
@@ -229,6 +232,7 @@ def group_message_list(request, group_id):
 @render_to('sentry/group/message.html')
 def group_message_details(request, group_id, message_id):
     group = get_object_or_404(GroupedMessage, pk=group_id)
+    group = with_pending_counts([group])[0]
 
     message = get_object_or_404(group.message_set, pk=message_id)
     
@@ -260,22 +264,69 @@ def group_message_details(request, group_id, message_id):
 
 @csrf_exempt
 def store(request):
-    key = request.POST.get('key')
-    if key != conf.KEY:
-        return HttpResponseForbidden('Invalid credentials')
-    
-    data = request.POST.get('data')
-    if not data:
-        return HttpResponseForbidden('Missing data')
-    try:
-        try:
-            data = pickle.loads(base64.b64decode(data).decode('zlib'))
-        except zlib.error:
-            data = pickle.loads(base64.b64decode(data))
-    except Exception:
-        return HttpResponseForbidden('Bad data')
+    response = _store(request)
+    # Lets clients know they can send the current wire format
+    response['X-Sentry-Version'] = str(wire.VERSION)
+    return response
 
-    GroupedMessage.objects.from_kwargs(**data)
+def _get_body_stream(request):
+    # Read the body straight from the WSGI input, so it isn't held in memory
+    # as raw_post_data as well
+    if not hasattr(request, '_raw_post_data') and 'wsgi.input' in getattr(request, 'environ', {}):
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        return request.environ['wsgi.input'], length
+    data = request.raw_post_data
+    return StringIO(data), len(data)
+
+def _store(request):
+    version = request.META.get('HTTP_X_SENTRY_VERSION')
+    if version:
+        key = request.META.get('HTTP_X_SENTRY_KEY')
+        if key != conf.KEY:
+            return HttpResponseForbidden('Invalid credentials')
+        if version != str(wire.VERSION):
+            return HttpResponseBadRequest('Unsupported version')
+
+        stream, length = _get_body_stream(request)
+        if not length:
+            return HttpResponseForbidden('Missing data')
+        try:
+            data = wire.read_body(stream, length, request.META.get('HTTP_CONTENT_ENCODING'),
+                                  max_size=conf.MAX_STORE_SIZE)
+        except wire.PayloadTooLarge:
+            return HttpResponse('Payload too large', status=413)
+        except (ValueError, zlib.error):
+            return HttpResponseBadRequest('Bad encoding')
+        try:
+            data = wire.decode(data)
+        except Exception:
+            return HttpResponseForbidden('Bad data')
+    else:
+        key = request.POST.get('key')
+        if key != conf.KEY:
+            return HttpResponseForbidden('Invalid credentials')
+        if not conf.ACCEPT_PICKLE:
+            return HttpResponseBadRequest('Unsupported version')
+
+        data = request.POST.get('data')
+        if not data:
+            return HttpResponseForbidden('Missing data')
+        try:
+            try:
+                data = pickle.loads(base64.b64decode(data).decode('zlib'))
+            except zlib.error:
+                data = pickle.loads(base64.b64decode(data))
+        except Exception:
+            return HttpResponseForbidden('Bad data')
+
+    # Queued clients send several events at once
+    if isinstance(data, list):
+        GroupedMessage.objects.from_kwargs_batch(data)
+    else:
+        GroupedMessage.objects.from_kwargs(**data)
     
     return HttpResponse()
 
@@ -0,0 +1,130 @@
+"""
+Encoding of the events clients send to the ``store`` view.
+
+Version 1 is the original format: a form field holding the base64 encoded,
+zlib compressed pickle of the event, along with the ``key`` field.
+
+Version 2 is sent when the request has an ``X-Sentry-Version: 2`` header. The
+body is the JSON of the event (or a list of events), compressed as given by
+the ``Content-Encoding`` header (``deflate`` or ``gzip``), and the key is
+passed in the ``X-Sentry-Key`` header. Servers which understand it answer
+with an ``X-Sentry-Version`` header, which lets clients fall back to version 1
+for older servers. Model instances, such as the ``project``, are sent as their
+primary key and fetched again by the server.
+"""
+import datetime
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+
+from sentry.helpers import NormalizedDict
+
+VERSION = 2
+
+CHUNK_SIZE = 64 * 1024
+
+class PayloadTooLarge(ValueError):
+    pass
+
+DATETIME_FORMAT = '%s %s' % (DjangoJSONEncoder.DATE_FORMAT, DjangoJSONEncoder.TIME_FORMAT)
+
+class WireEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if isinstance(o, models.Model):
+            return o.pk
+        try:
+            return DjangoJSONEncoder.default(self, o)
+        except TypeError:
+            return smart_unicode(o)
+
+def encode(payload):
+    """
+    Encodes an event, or a list of events, in the version 2 format.
+    """
+    return simplejson.dumps(payload, cls=WireEncoder, separators=(',', ':'))
+
+def decode(data):
+    """
+    Decodes a (decompressed) version 2 body into an event or a list of
+    events.
+    """
+    payload = simplejson.loads(data)
+    # Instances fetched so far, as events of a batch share their project
+    instances = {}
+    if isinstance(payload, list):
+        return [_decode_event(e, instances) for e in payload]
+    return _decode_event(payload, instances)
+
+def get_related_fields():
+    """
+    Returns the names of the event arguments which are model instances, i.e.
+    the foreign keys of ``Message``.
+    """
+    from sentry.models import Message
+
+    return [f.name for f in Message._meta.fields if f.rel is not None]
+
+def _get_instance(name, pk, instances):
+    key = (name, pk)
+    if key not in instances:
+        from sentry.models import Message
+
+        model = Message._meta.get_field(name).rel.to
+        instances[key] = model._default_manager.get(pk=pk)
+    return instances[key]
+
+def _decode_event(event, instances):
+    # Keys are used as keyword arguments, which must be str
+    event = dict((str(k), v) for k, v in event.iteritems())
+    for key in ('datetime', 'first_seen', 'last_seen'):
+        if isinstance(event.get(key), basestring):
+            event[key] = datetime.datetime.strptime(event[key], DATETIME_FORMAT)
+    for key in get_related_fields():
+        if isinstance(event.get(key), (int, long)):
+            event[key] = _get_instance(key, event[key], instances)
+    # JSON only holds values which are normalized already
+    if isinstance(event.get('data'), dict):
+        event['data'] = NormalizedDict(event['data'])
+    return event
+
+def read_body(stream, length, encoding=None, max_size=None):
+    """
+    Reads ``length`` bytes from the file-like ``stream`` in chunks,
+    decompressing them as they arrive according to ``encoding`` (a
+    ``Content-Encoding``). Raises ``PayloadTooLarge`` as soon as the body
+    turns out to be larger than ``max_size`` bytes.
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+    elif encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'identity':
+        decompressor = None
+    else:
+        raise ValueError('Unsupported encoding: %s' % (encoding,))
+    if max_size and length > max_size:
+        raise PayloadTooLarge()
+
+    chunks = []
+    size = 0
+    while length > 0:
+        chunk = stream.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        if decompressor is not None:
+            # Never inflate more than one byte past the limit
+            chunk = decompressor.decompress(chunk, max_size and max_size - size + 1 or 0)
+            if decompressor.unconsumed_tail:
+                raise PayloadTooLarge()
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise PayloadTooLarge()
+        chunks.append(chunk)
+    if decompressor is not None:
+        chunks.append(decompressor.flush())
+    return ''.join(chunks)
@@ -0,0 +1,106 @@
+"""
+A bounded queue drained in batches by a daemon thread, used to move slow
+work (mail, network I/O) out of the code path which produced it.
+"""
+import Queue
+import logging
+import threading
+import time
+
+logger = logging.getLogger('sentry.errors')
+
+class QueueWorker(object):
+    """
+    Calls ``process`` from a daemon thread with lists of queued items. A batch
+    is handed over once it holds ``batch_size`` items or ``interval`` seconds
+    after its first item was queued, whichever comes first.
+
+    When the queue is full (``maxsize``) either the new item is dropped
+    (``policy='drop_newest'``) or the oldest queued item is discarded to make
+    room for it (``policy='drop_oldest'``). Dropped items are counted in
+    ``dropped``.
+    """
+    def __init__(self, process, interval=1.0, batch_size=100, maxsize=1000, policy='drop_newest'):
+        if policy not in ('drop_newest', 'drop_oldest'):
+            raise ValueError('Unknown queue policy: %r' % (policy,))
+        self.process = process
+        self.interval = interval
+        self.batch_size = batch_size
+        self.policy = policy
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, item):
+        """
+        Queues ``item``, returning ``False`` if it had to be dropped.
+        """
+        self._ensure_thread()
+        while True:
+            try:
+                self.queue.put_nowait(item)
+            except Queue.Full:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                else:
+                    self.dropped += 1
+            else:
+                return True
+
+    def flush(self):
+        """
+        Processes everything which is currently queued in the calling thread.
+        """
+        while True:
+            batch = self._get_batch(block=False)
+            if not batch:
+                break
+            self._process(batch)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.isAlive():
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _get_batch(self, block=True):
+        try:
+            batch = [self.queue.get(block)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if block and remaining > 0:
+                    batch.append(self.queue.get(True, remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _process(self, batch):
+        try:
+            self.process(batch)
+        except Exception, exc:
+            try:
+                logger.exception(u'Unable to process queued items: %s' % (exc,))
+            except Exception:
+                pass
+
+    def _run(self):
+        while True:
+            self._process(self._get_batch())
@@ -15,6 +15,10 @@ setup(
         'django-paging>=0.2.2',
         'django-indexer==0.2',
     ],
+    extras_require={
+        # sentry.client.aio.AsyncSentryClient
+        'asyncio': ['trollius'],
+    },
     include_package_data=True,
     classifiers=[
         'Framework :: Django',